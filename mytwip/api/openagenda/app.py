@@ -1,10 +1,25 @@
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, File, UploadFile, Form, Depends, Request
-from mytwip.core.openagenda import core
+from fastapi import FastAPI, File, UploadFile, Form, Depends, Request, Body, Query
+from fastapi.responses import StreamingResponse, PlainTextResponse, HTMLResponse, JSONResponse, Response
+from mytwip.core.openagenda import core, backfill, refresher
 from mytwip.core.openagenda.core import *
 from mytwip.utils.common import *
-from mytwip.utils.security import rate_limit
+from mytwip.utils.security import rate_limit, is_admin
+from mytwip.utils.metrics import Histogram, metrics_render
+from mytwip.utils.tracing import trace_start, trace_summary, trace_server_timing
+from email.utils import formatdate, parsedate_to_datetime
+import asyncio
+import cProfile
+import io
 import json
+import pstats
+
+try:
+    import pyinstrument
+except ImportError:  # Optional : cProfile is used instead
+    pyinstrument = None
+
+PROFILE_MAX_LINES = 60  # Functions listed in cProfile output
 
 # Setup application lifespan
 @asynccontextmanager
@@ -12,13 +27,20 @@ async def lifespan(app: FastAPI):
     """Handle application lifespan events"""
     global logger
     # Startup
-    openagenda_cached_query_cleanup()
     logger = logger_init()
     logger.info("Parsing API starting up")
+    openagenda_cached_query_sweeper_start()
+    events_index_sync_start()
+    backfill.backfill_resume_all()
+    refresher.refresher_start()
 
     yield  # This is where the application runs
     
     # Shutdown
+    openagenda_cached_query_sweeper_stop()
+    refresher.refresher_stop()
+    backfill.backfill_stop_all()
+    await openagenda_client_close()
     logger.info("Parsing API shutting down")
 
 # Initialize FastAPI app
@@ -29,6 +51,122 @@ app = FastAPI(
     version="1.0.0",
 )
 
+# Profilers cannot be nested : one profiled request at a time
+profile_lock = asyncio.Lock()
+route_duration_metric = Histogram("http_request_duration_seconds", "API requests duration by route", ("method", "route", "status"))
+
+# Trace each request : Server-Timing header with time spent in each phase, structured log line, duration by route template metric
+@app.middleware("http")
+async def request_trace(request: Request, call_next):
+    if request.query_params.get("profile") in ("1", "true") and is_admin(request):
+        return await request_profile(request, call_next)
+    spans = trace_start()
+    timer_id = perf_timer_start()
+    # A failing request is still timed, measured and logged, as a 500
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        timer = perf_timer_stop(timer_id)
+        summary = trace_summary(spans)
+        # Route template rather than path, to keep metric labels bounded
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        route_duration_metric.observe(timer["duration"], method=request.method, route=route_path, status=status)
+        logger.info("request %s", json.dumps({
+            "method": request.method,
+            "path": request.url.path,
+            "route": route_path,
+            "status": status,
+            "duration": round(timer["duration"], 6),
+            "spans": {name: {"duration": round(item["duration"], 6), "count": item["count"]} for name, item in summary.items()},
+        }))
+    response.headers["Server-Timing"] = trace_server_timing(summary, timer["duration"])
+
+    return response
+
+# Run request under a profiler, returning the profile instead of the response : pyinstrument sampling profiler if installed, cProfile otherwise
+async def request_profile(request: Request, call_next):
+    async with profile_lock:
+        if pyinstrument is not None:
+            profiler = pyinstrument.Profiler(async_mode="enabled")
+            profiler.start()
+            try:
+                response = await call_next(request)
+                # Response body is streamed : consume it while profiling
+                async for chunk in response.body_iterator:
+                    pass
+            finally:
+                profiler.stop()
+            result = HTMLResponse(profiler.output_html())
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                response = await call_next(request)
+                async for chunk in response.body_iterator:
+                    pass
+            finally:
+                profiler.disable()
+            profile_output = io.StringIO()
+            pstats.Stats(profiler, stream=profile_output).sort_stats("cumulative").print_stats(PROFILE_MAX_LINES)
+            result = PlainTextResponse(profile_output.getvalue())
+
+    return result
+
+# ETag, Last-Modified and Cache-Control headers, from store validators
+def validators_headers(validators: dict) -> dict:
+    cache_control = f"public, max-age={max(int(validators["max_age"]), 0)}"
+    if STALE_WHILE_REVALIDATE:
+        cache_control+= f", stale-while-revalidate={REFRESHER_INTERVAL}"
+
+    return {
+        "ETag": f'"{validators["etag"]}"',
+        "Last-Modified": formatdate(validators["last_modified"], usegmt=True),
+        "Cache-Control": cache_control,
+    }
+
+# Does conditional request match validators ? If-None-Match, or If-Modified-Since without it
+def not_modified(request: Request, validators: dict) -> bool:
+    result = False
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        etags = [etag.strip().removeprefix("W/") for etag in if_none_match.split(",")]
+        result = "*" in etags or f'"{validators["etag"]}"' in etags
+    elif if_modified_since:
+        try:
+            result = int(validators["last_modified"]) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            result = False
+
+    return result
+
+# Conditional GET : 304 without loading the store when client version is still fresh, validators headers on the result otherwise
+async def conditional_response(request: Request, validators_get, result_get):
+    validators = validators_get()
+    if validators is not None and validators["max_age"] > 0 and not_modified(request, validators):
+        return Response(status_code=304, headers=validators_headers(validators))
+    result = await result_get()
+    # Store may have been refreshed by the query
+    validators = validators_get()
+    if validators is None or result.get("status") != "success":
+        return result
+    if not_modified(request, validators):
+        return Response(status_code=304, headers=validators_headers(validators))
+
+    return JSONResponse(result, headers=validators_headers(validators))
+
+# Is NDJSON streaming requested, by Accept header or stream query flag ?
+def ndjson_requested(request: Request, stream: bool) -> bool:
+    return stream or "application/x-ndjson" in request.headers.get("accept", "")
+
+# Stream items as NDJSON, one JSON document per line
+async def ndjson_stream(items):
+    async for item in items:
+        yield json.dumps(item) + "\n"
+
 @app.get("/")
 async def root(request: Request, api_key: str = Depends(rate_limit)):
     """
@@ -46,7 +184,7 @@ async def agendas_search(request: Request, api_key: str = Depends(rate_limit), s
     logger.info("/agendas/search/%s", search_term)
     result = {"status": "unknown", "msg": "Unkown status"}
     search_term = search_term.strip()
-    result = core.agendas_search(search_term)
+    result = await core.agendas_search(search_term)
         
     return result
 
@@ -59,7 +197,7 @@ async def agendas_by_slug(request: Request, api_key: str = Depends(rate_limit),
     logger.info("/agendas/by_slug/%s", agenda_slug)
     result = {"status": "unknown", "msg": "Unkown status"}
     agenda_slug = agenda_slug.strip()
-    result = core.agendas_by_slug(agenda_slug)
+    result = await core.agendas_by_slug(agenda_slug)
         
     return result
 
@@ -71,43 +209,150 @@ async def agendas_details(request: Request, api_key: str = Depends(rate_limit),
     """
     logger.info("/agendas/details/%s", agenda_uid)
     result = {"status": "unknown", "msg": "Unkown status"}
-    result = core.agendas_details(agenda_uid)
+    result = await conditional_response(request, lambda: core.agendas_validators(agenda_uid), lambda: core.agendas_details(agenda_uid))
         
     return result
 
 @app.get("/agendas/with_events/{agenda_uid}")
-async def agendas_with_events(request: Request, api_key: str = Depends(rate_limit), agenda_uid: int|None = None):
+async def agendas_with_events(request: Request, api_key: str = Depends(rate_limit), agenda_uid: int|None = None, stream: bool = False, limit: int|None = None, cursor: str|None = None, date_from: str|None = None, date_to: str|None = None, keyword: str|None = None, fields: str|None = None):
     """
     Search for OpenAgenda agendas by uid, with its events
     - **agenda_uid**: The ID of this agenda on the OpenAgenda platform.
+    - **stream**: If specified and true, or with Accept: application/x-ndjson header, streams NDJSON : agenda details result on first line, then one event per line.
+    - **limit**, **cursor**: Page size, and next_cursor of previous page. Any of these filtering parameters returns a page of stored events.
+    - **date_from**, **date_to**: ISO 8601 dates or datetimes, events with a timing overlapping [date_from, date_to[.
+    - **keyword**: Case insensitive keyword, in events title, description or keywords.
+    - **fields**: Comma separated event fields to return.
     """
     logger.info("/agendas/with_events/%s", agenda_uid)
+    events_filtered = any(param is not None for param in (limit, cursor, date_from, date_to, keyword, fields))
+    if ndjson_requested(request, stream) and not events_filtered:
+        async def agenda_with_events_iter():
+            yield await core.agendas_details(agenda_uid)
+            async for event in core.events_iter_by_agenda_uid(agenda_uid):
+                yield event
+        return StreamingResponse(ndjson_stream(agenda_with_events_iter()), media_type="application/x-ndjson")
+
     result = {"status": "unknown", "msg": "Unkown status"}
-    agenda_result = core.agendas_details(agenda_uid)
-    events_result = core.events_by_agenda_uid(agenda_uid)
-    result["status"] = "success" if (agenda_result.get("status", "failure") == "success" and events_result.get("status", "failure") == "success") else "failure"
-    result["msg"] = f"Agenda : {agenda_result.get("msg") if "msg" in agenda_result else "No msg"}. Events : {events_result.get("msg") if "msg" in events_result else "No msg"}.".replace("..", ".")
-    result["data"] = {
-        "agenda": agenda_result.get("data", {}).get("agenda", None),
-        "events" : events_result.get("data", {}).get("events", []),
-        "events_total": events_result.get("data", {}).get("total", 0),
-        "events_pages": events_result.get("data", {}).get("pages", 0)
-    }
+    result = await conditional_response(
+        request,
+        lambda: core.agendas_with_events_validators(agenda_uid),
+        lambda: core.agendas_with_events(agenda_uid, limit, cursor, date_from, date_to, keyword, fields)
+    )
     
     return result
 
+@app.post("/agendas/with_events")
+async def agendas_with_events_bulk(request: Request, api_key: str = Depends(rate_limit), agenda_uids: list[int] = Body(...)):
+    """
+    Search for many OpenAgenda agendas by uid, with their events. Streams NDJSON, one agenda result per line, in completion order.
+    Cached agendas come first, missing ones are fetched concurrently under OpenAgenda rate limit.
+    - **agenda_uids**: JSON list of the IDs of the agendas on the OpenAgenda platform, at most BULK_MAX_AGENDAS.
+    """
+    logger.info("/agendas/with_events (%s agendas)", len(agenda_uids))
+    if len(agenda_uids) > BULK_MAX_AGENDAS:
+        return {"status": "failure", "msg": f"No more than {BULK_MAX_AGENDAS} agendas per query"}
+
+    return StreamingResponse(ndjson_stream(core.agendas_with_events_bulk(agenda_uids)), media_type="application/x-ndjson")
+
 @app.get("/events/by_agenda_uid/{agenda_uid}")
-async def events_by_agenda_uid(request: Request, api_key: str = Depends(rate_limit), agenda_uid: int|None = None):
+async def events_by_agenda_uid(request: Request, api_key: str = Depends(rate_limit), agenda_uid: int|None = None, stream: bool = False, limit: int|None = None, cursor: str|None = None, date_from: str|None = None, date_to: str|None = None, keyword: str|None = None, fields: str|None = None):
     """
     Search for OpenAgenda events by agenda uid
     - **agenda_uid**: The ID of the agenda for which you want to retrieve the events.
+    - **stream**: If specified and true, or with Accept: application/x-ndjson header, streams NDJSON : one event per line.
+    - **limit**, **cursor**: Page size, and next_cursor of previous page. Any of these filtering parameters returns a page of stored events.
+    - **date_from**, **date_to**: ISO 8601 dates or datetimes, events with a timing overlapping [date_from, date_to[.
+    - **keyword**: Case insensitive keyword, in events title, description or keywords.
+    - **fields**: Comma separated event fields to return.
     """
     logger.info("/events/by_agenda_uid/%s", agenda_uid)
+    events_filtered = any(param is not None for param in (limit, cursor, date_from, date_to, keyword, fields))
+    if ndjson_requested(request, stream) and not events_filtered:
+        return StreamingResponse(ndjson_stream(core.events_iter_by_agenda_uid(agenda_uid)), media_type="application/x-ndjson")
+
     result = {"status": "unknown", "msg": "Unkown status"}
-    result = core.events_by_agenda_uid(agenda_uid)
+    if events_filtered:
+        result = await conditional_response(
+            request,
+            lambda: core.events_validators(agenda_uid),
+            lambda: core.events_query(agenda_uid, limit, cursor, date_from, date_to, keyword, fields)
+        )
+    else:
+        result = await conditional_response(request, lambda: core.events_validators(agenda_uid), lambda: core.events_by_agenda_uid(agenda_uid))
         
     return result
 
+@app.get("/events/search")
+async def events_search(request: Request, api_key: str = Depends(rate_limit), search_term: str = "", agenda_uid: int|None = None, limit: int|None = None, cursor: str|None = None, fields: str|None = None):
+    """
+    Search for stored events of all agendas by text, best matches first. OpenAgenda platform is not queried.
+    - **search_term**: Words in events title, description or keywords, in any language, accents ignored. All words are required, the last one as a prefix.
+    - **agenda_uid**: If specified, only events of this agenda.
+    - **limit**, **cursor**: Page size, and next_cursor of previous page.
+    - **fields**: Comma separated event fields to return.
+    """
+    logger.info("/events/search (%s)", search_term)
+    result = {"status": "unknown", "msg": "Unkown status"}
+    result = await core.events_search(search_term, agenda_uid, limit, cursor, fields)
+
+    return result
+
+@app.get("/events/between")
+async def events_between(request: Request, api_key: str = Depends(rate_limit), date_from: str = "", date_to: str = "", agenda_uid: int|None = None, limit: int|None = None, cursor: str|None = None, fields: str|None = None):
+    """
+    Search for stored events of all agendas with a timing overlapping [date_from, date_to[, by first overlapping timing. OpenAgenda platform is not queried.
+    - **date_from**, **date_to**: ISO 8601 dates or datetimes, UTC if without offset.
+    - **agenda_uid**: If specified, only events of this agenda.
+    - **limit**, **cursor**: Page size, and next_cursor of previous page.
+    - **fields**: Comma separated event fields to return.
+    """
+    logger.info("/events/between (%s / %s)", date_from, date_to)
+    result = {"status": "unknown", "msg": "Unkown status"}
+    result = await core.events_between(date_from, date_to, agenda_uid, limit, cursor, fields)
+
+    return result
+
+@app.get("/events/near")
+async def events_near(request: Request, api_key: str = Depends(rate_limit), latitude: float|None = None, longitude: float|None = None, radius: float|None = Query(None, gt=0), bbox: str|None = None, date_from: str|None = None, date_to: str|None = None, agenda_uid: int|None = None, limit: int|None = None, cursor: str|None = None, fields: str|None = None):
+    """
+    Search for stored events of all agendas by location, nearest first, with their distance in km. OpenAgenda platform is not queried.
+    - **latitude**, **longitude**, **radius**: Events within radius km of the point, radius > 0.
+    - **bbox**: south,west,north,east in degrees, events in this box instead. Distances from latitude / longitude if specified, from box center otherwise.
+    - **date_from**, **date_to**: ISO 8601 dates or datetimes, if specified only events with a timing overlapping [date_from, date_to[.
+    - **agenda_uid**: If specified, only events of this agenda.
+    - **limit**, **cursor**: Page size, and next_cursor of previous page.
+    - **fields**: Comma separated event fields to return.
+    """
+    logger.info("/events/near (%s,%s / %s / %s)", latitude, longitude, radius, bbox)
+    result = {"status": "unknown", "msg": "Unkown status"}
+    result = await core.events_near(latitude, longitude, radius, bbox, date_from, date_to, agenda_uid, limit, cursor, fields)
+
+    return result
+
+@app.post("/backfill/{agenda_uid}")
+async def backfill_start(request: Request, api_key: str = Depends(rate_limit), agenda_uid: int|None = None, restart: bool = False):
+    """
+    Start full backfill of agenda events, beyond OpenAgenda max pages, or resume it from its checkpoint. A backfill already running is left as is, flagged already_running
+    - **agenda_uid**: The ID of the agenda to backfill.
+    - **restart**: If specified and true, restarts backfill from the first page.
+    """
+    logger.info("/backfill/%s (restart : %s)", agenda_uid, restart)
+    result = backfill.backfill_start(agenda_uid, restart)
+
+    return result
+
+@app.get("/backfill/{agenda_uid}")
+async def backfill_status(request: Request, api_key: str = Depends(rate_limit), agenda_uid: int|None = None):
+    """
+    Progress of agenda events backfill
+    - **agenda_uid**: The ID of the backfilled agenda.
+    """
+    logger.info("/backfill/%s", agenda_uid)
+    result = backfill.backfill_status(agenda_uid)
+
+    return result
+
 @app.get("/cache_query_cleanup")
 async def cache_query_cleanup(request: Request, api_key: str = Depends(rate_limit), force: bool = False):
     """
@@ -119,3 +364,19 @@ async def cache_query_cleanup(request: Request, api_key: str = Depends(rate_limi
 
     return result
 
+@app.get("/stats")
+async def stats(request: Request, api_key: str = Depends(rate_limit)):
+    """
+    Counters of OpenAgenda queries layer
+    """
+    logger.info("/stats")
+    result = openagenda_stats_get()
+
+    return result
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics(request: Request, api_key: str = Depends(rate_limit)):
+    """
+    Metrics of this worker, in Prometheus text format
+    """
+    return PlainTextResponse(metrics_render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,240 @@
+"""
+OpenAgenda API benchmark : starts the fake OpenAgenda server and the API in a scratch data directory, then runs
+a cold cache scenario (empty stores and caches) and a warm cache one (same queries again) against each route.
+Reports throughput, latency percentiles, errors, upstream calls and API peak RSS by route.
+"""
+from mytwip.bench.openagenda import fake_server
+import argparse
+import asyncio
+import httpx
+import json
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_HOST = "127.0.0.1"
+BENCH_API_PORT = 9200
+BENCH_FAKE_PORT = 9201
+BENCH_STARTUP_TIMEOUT = 30  # Seconds to wait for servers to accept queries
+BENCH_TIMEOUT = 120  # Seconds per query
+
+# Benchmarked routes, in order : (name, method, path template, JSON body). [[agenda_uid]] and [[agenda_uids]] are replaced per query
+BENCH_ROUTES = [
+    ("root", "GET", "/", None),
+    ("agendas_search", "GET", "/agendas/search/Agenda%20[[agenda_uid]]", None),
+    ("agendas_by_slug", "GET", "/agendas/by_slug/agenda-[[agenda_uid]]", None),
+    ("agendas_details", "GET", "/agendas/details/[[agenda_uid]]", None),
+    ("events_by_agenda_uid", "GET", "/events/by_agenda_uid/[[agenda_uid]]", None),
+    ("events_by_agenda_uid_page", "GET", "/events/by_agenda_uid/[[agenda_uid]]?limit=20&keyword=jazz", None),
+    ("events_by_agenda_uid_stream", "GET", "/events/by_agenda_uid/[[agenda_uid]]?stream=true", None),
+    ("agendas_with_events", "GET", "/agendas/with_events/[[agenda_uid]]", None),
+    ("agendas_with_events_page", "GET", "/agendas/with_events/[[agenda_uid]]?limit=20&date_from=2024-06-01&date_to=2024-07-01", None),
+    ("agendas_with_events_stream", "GET", "/agendas/with_events/[[agenda_uid]]?stream=true", None),
+    ("agendas_with_events_bulk", "POST", "/agendas/with_events", "[[agenda_uids]]"),
+    ("events_search", "GET", "/events/search?search_term=concert%20ja&limit=20", None),
+    ("events_between", "GET", "/events/between?date_from=2024-03-01&date_to=2024-03-15&limit=20", None),
+    ("events_near", "GET", "/events/near?latitude=48.8566&longitude=2.3522&radius=5&limit=20", None),
+    ("cache_query_cleanup", "GET", "/cache_query_cleanup", None),
+    ("stats", "GET", "/stats", None),
+    ("metrics", "GET", "/metrics", None),
+    # Last : backfills go on querying OpenAgenda in background
+    ("backfill_start", "POST", "/backfill/[[agenda_uid]]", None),
+    ("backfill_status", "GET", "/backfill/[[agenda_uid]]", None),
+]
+
+
+# Start a uvicorn server in a subprocess
+def bench_server_start(app: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", BENCH_HOST, "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+
+def bench_server_stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+# Wait until server answers on url
+async def bench_server_wait(client: httpx.AsyncClient, url: str, process: subprocess.Popen):
+    deadline = time.monotonic() + BENCH_STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited : {process.stderr.read().decode(errors='replace')}")
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Server not ready after {BENCH_STARTUP_TIMEOUT}s : {url}")
+
+# Current and peak resident memory of process, in kB
+def bench_rss_get(pid: int) -> dict:
+    result = {"rss_kb": None, "peak_rss_kb": None}
+    try:
+        with open(f"/proc/{pid}/status", "r") as file_in:
+            for line in file_in:
+                if line.startswith("VmRSS:"):
+                    result["rss_kb"] = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    result["peak_rss_kb"] = int(line.split()[1])
+    except FileNotFoundError:
+        pass
+
+    return result
+
+def bench_percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values) + 0.5) - 1))
+
+    return values[index]
+
+async def bench_upstream_calls(client: httpx.AsyncClient) -> int:
+    response = await client.get(f"http://{BENCH_HOST}:{BENCH_FAKE_PORT}/_calls")
+    calls = response.json()
+
+    return sum(count for kind, count in calls.items() if kind in ("agendas", "agenda", "events"))
+
+# Run queries of a route, concurrency at a time, and measure them
+async def bench_route(client: httpx.AsyncClient, route: tuple, agenda_uids: list[int], nb_queries: int, concurrency: int, bulk_size: int) -> dict:
+    name, method, path_tpl, body_tpl = route
+    durations = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bench_query(index: int):
+        nonlocal errors
+        agenda_uid = agenda_uids[index % len(agenda_uids)]
+        path = path_tpl.replace("[[agenda_uid]]", str(agenda_uid))
+        body = None
+        if body_tpl == "[[agenda_uids]]":
+            body = [agenda_uids[(index * bulk_size + offset) % len(agenda_uids)] for offset in range(bulk_size)]
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                # Streams are read to the end : the query lasts until the last line
+                await response.aread()
+                if response.status_code >= 500 or response.status_code == 429:
+                    errors+= 1
+            except httpx.HTTPError:
+                errors+= 1
+            durations.append(time.perf_counter() - start)
+
+    upstream_before = await bench_upstream_calls(client)
+    start = time.perf_counter()
+    await asyncio.gather(*(bench_query(index) for index in range(nb_queries)))
+    elapsed = time.perf_counter() - start
+    upstream_after = await bench_upstream_calls(client)
+    result = {
+        "route": name,
+        "queries": nb_queries,
+        "errors": errors,
+        "throughput": nb_queries / elapsed if elapsed else 0.0,
+        "p50_ms": bench_percentile(durations, 50) * 1000,
+        "p95_ms": bench_percentile(durations, 95) * 1000,
+        "p99_ms": bench_percentile(durations, 99) * 1000,
+        "upstream_calls": upstream_after - upstream_before,
+    }
+
+    return result
+
+# Run all routes, in order, against a running API
+async def bench_scenario(client: httpx.AsyncClient, name: str, api_pid: int, routes: list, args) -> dict:
+    agenda_uids = list(range(1, args.agendas + 1))
+    result = {"scenario": name, "routes": []}
+    for route in routes:
+        route_result = await bench_route(client, route, agenda_uids, args.queries, args.concurrency, args.bulk_size)
+        route_result.update(bench_rss_get(api_pid))
+        result["routes"].append(route_result)
+    result.update(bench_rss_get(api_pid))
+
+    return result
+
+def bench_report(results: list[dict]):
+    header = f"{'route':<28} {'queries':>7} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'upstream':>8} {'rss MB':>7}"
+    for scenario in results:
+        print(f"\n== {scenario['scenario']} (peak RSS {(scenario['peak_rss_kb'] or 0) / 1024:.1f} MB)")
+        print(header)
+        for item in scenario["routes"]:
+            print(
+                f"{item['route']:<28} {item['queries']:>7} {item['errors']:>6} {item['throughput']:>8.1f} {item['p50_ms']:>8.1f} "
+                f"{item['p95_ms']:>8.1f} {item['p99_ms']:>8.1f} {item['upstream_calls']:>8} {(item['rss_kb'] or 0) / 1024:>7.1f}"
+            )
+
+async def bench_run(args) -> list[dict]:
+    routes = [route for route in BENCH_ROUTES if not args.routes or route[0] in args.routes]
+    api_key = secrets.token_hex(16)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="openagenda_bench_") as data_root:
+        fake_env = {
+            **os.environ,
+            "FAKE_AGENDAS": str(args.agendas),
+            "FAKE_EVENTS_PER_AGENDA": str(args.events),
+            "FAKE_LATENCY": str(args.latency),
+            "FAKE_429_RATE": str(args.throttle_rate),
+            "FAKE_SEED": str(args.seed),
+        }
+        api_env = {
+            **os.environ,
+            "OPENAGENDA_URL_START": f"http://{BENCH_HOST}:{BENCH_FAKE_PORT}/v2/agendas",
+            "OPENAGENDA_DATA_ROOT": data_root,
+            "OPENAGENDA_SPEED_LIMIT": str(args.speed_limit),
+            "OPENAGENDA_BURST": str(args.burst),
+            "OPENAGENDA_PUBLIC_KEY": "bench",
+            "API_KEY": api_key,
+            "RATE_LIMIT_ENABLED": "false",
+            "RATE_LIMIT_DB": f"{data_root}/rate_limit.sqlite3",
+        }
+        fake_process = bench_server_start("mytwip.bench.openagenda.fake_server:app", BENCH_FAKE_PORT, fake_env)
+        api_process = bench_server_start("mytwip.api.openagenda.app:app", BENCH_API_PORT, api_env)
+        try:
+            async with httpx.AsyncClient(
+                base_url=f"http://{BENCH_HOST}:{BENCH_API_PORT}",
+                headers={"X-API-Key": api_key},
+                timeout=BENCH_TIMEOUT,
+                limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency),
+            ) as client:
+                await bench_server_wait(client, f"http://{BENCH_HOST}:{BENCH_FAKE_PORT}/_calls", fake_process)
+                await bench_server_wait(client, "/", api_process)
+                results.append(await bench_scenario(client, "cold", api_process.pid, routes, args))
+                results.append(await bench_scenario(client, "warm", api_process.pid, routes, args))
+        finally:
+            bench_server_stop(api_process)
+            bench_server_stop(fake_process)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAgenda API benchmark, against a local fake OpenAgenda server")
+    parser.add_argument("--agendas", type=int, default=50, help="Agendas queried, uid 1 to AGENDAS (multiples of 17 are 404s)")
+    parser.add_argument("--events", type=int, default=fake_server.FAKE_EVENTS_PER_AGENDA, help="Max events per agenda")
+    parser.add_argument("--queries", type=int, default=100, help="Queries per route and scenario")
+    parser.add_argument("--concurrency", type=int, default=10, help="Queries in flight")
+    parser.add_argument("--bulk-size", type=int, default=10, help="Agendas per bulk query")
+    parser.add_argument("--latency", type=float, default=fake_server.FAKE_LATENCY, help="Fake OpenAgenda latency, in seconds")
+    parser.add_argument("--throttle-rate", type=float, default=fake_server.FAKE_429_RATE, help="Part of fake OpenAgenda queries answered 429")
+    parser.add_argument("--speed-limit", type=float, default=0.001, help="OPENAGENDA_SPEED_LIMIT of the API, in seconds")
+    parser.add_argument("--burst", type=int, default=20, help="OPENAGENDA_BURST of the API")
+    parser.add_argument("--seed", type=int, default=fake_server.FAKE_SEED, help="Fake data and throttling seed")
+    parser.add_argument("--routes", nargs="*", help="Only these routes, by name")
+    parser.add_argument("--json", help="Also write results to this JSON file")
+    args = parser.parse_args()
+
+    results = asyncio.run(bench_run(args))
+    bench_report(results)
+    if args.json:
+        with open(args.json, "w") as file_out:
+            json.dump(results, file_out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Fake OpenAgenda server for benchmarks : synthetic agendas and events, after[] cursors, 404s, latency and 429s.
+Same data for the same parameters : agendas and events are generated from their uid.
+Run : uvicorn mytwip.bench.openagenda.fake_server:app --port 9100, then point OPENAGENDA_URL_START to http://127.0.0.1:9100/v2/agendas
+"""
+from collections import Counter
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import asyncio
+import os
+import random
+
+FAKE_AGENDAS = int(os.getenv("FAKE_AGENDAS", "200"))  # Agendas uid 1 to FAKE_AGENDAS
+FAKE_EVENTS_PER_AGENDA = int(os.getenv("FAKE_EVENTS_PER_AGENDA", "300"))  # Agenda events vary from half to all of it
+FAKE_LATENCY = float(os.getenv("FAKE_LATENCY", "0.05"))  # Response latency, in seconds
+FAKE_LATENCY_JITTER = float(os.getenv("FAKE_LATENCY_JITTER", "0.02"))
+FAKE_404_EVERY = int(os.getenv("FAKE_404_EVERY", "17"))  # Agendas with uid multiple of it do not exist
+FAKE_429_RATE = float(os.getenv("FAKE_429_RATE", "0.02"))  # Part of queries throttled
+FAKE_RETRY_AFTER = os.getenv("FAKE_RETRY_AFTER", "0.2")  # Retry-After header of throttled queries, in seconds
+FAKE_SEED = int(os.getenv("FAKE_SEED", "42"))
+
+# Cities events are located around : (name, latitude, longitude)
+FAKE_CITIES = [("Paris", 48.8566, 2.3522), ("Lyon", 45.764, 4.8357), ("Marseille", 43.2965, 5.3698), ("Lille", 50.6292, 3.0573), ("Nantes", 47.2184, -1.5536)]
+FAKE_WORDS = ["concert", "jazz", "théâtre", "exposition", "atelier", "festival", "cinéma", "danse", "conférence", "marché", "musique", "enfants"]
+
+app = FastAPI(title="Fake OpenAgenda")
+calls = Counter()
+# Throttling decisions, repeatable from one run to the next
+throttle_random = random.Random(FAKE_SEED)
+
+
+def fake_agenda_exists(agenda_uid: int) -> bool:
+    return 1 <= agenda_uid <= FAKE_AGENDAS and agenda_uid % FAKE_404_EVERY != 0
+
+def fake_agenda(agenda_uid: int) -> dict:
+    return {
+        "uid": agenda_uid,
+        "slug": f"agenda-{agenda_uid}",
+        "title": f"Agenda {agenda_uid}",
+        "description": {"fr": f"Agenda de test {agenda_uid}"},
+        "updatedAt": "2024-01-01T00:00:00.000Z",
+    }
+
+# Events of agenda, most recently updated first
+def fake_events(agenda_uid: int) -> list[dict]:
+    generator = random.Random(FAKE_SEED * 100_003 + agenda_uid)
+    result = []
+    for index in range(FAKE_EVENTS_PER_AGENDA // 2 + generator.randrange(FAKE_EVENTS_PER_AGENDA // 2 + 1)):
+        city, latitude, longitude = generator.choice(FAKE_CITIES)
+        words = generator.sample(FAKE_WORDS, 3)
+        day = 1 + generator.randrange(28)
+        hour = 10 + generator.randrange(12)
+        result.append({
+            "uid": agenda_uid * 100_000 + index,
+            "title": {"fr": f"{words[0].capitalize()} {words[1]} à {city}", "en": f"{words[0]} {words[1]} in {city}"},
+            "description": {"fr": f"{words[2].capitalize()} pour tous, {city}"},
+            "keywords": {"fr": words},
+            "timings": [{"begin": f"2024-{1 + index % 12:02d}-{day:02d}T{hour:02d}:00:00+0100", "end": f"2024-{1 + index % 12:02d}-{day:02d}T{hour + 2:02d}:00:00+0100"}],
+            "location": {"city": city, "latitude": latitude + generator.uniform(-0.1, 0.1), "longitude": longitude + generator.uniform(-0.1, 0.1)},
+            "updatedAt": f"2024-{12 - index * 12 // FAKE_EVENTS_PER_AGENDA:02d}-01T00:00:00.000Z",
+        })
+
+    return result
+
+# Page of items from after[] cursor : [offset, uid of last item of previous page]
+def fake_page(items: list[dict], request: Request) -> tuple[dict, list[dict]]:
+    size = int(request.query_params.get("size", "20"))
+    after = request.query_params.getlist("after[]")
+    offset = int(after[0]) if after else 0
+    page = items[offset:offset + size]
+    result = {"total": len(items), "after": [offset + len(page), page[-1]["uid"]] if page and offset + size < len(items) else None}
+
+    return result, page
+
+# Latency, and throttling of part of the queries
+async def fake_delay(kind: str) -> JSONResponse|None:
+    calls[kind]+= 1
+    await asyncio.sleep(max(0.0, FAKE_LATENCY + throttle_random.uniform(-FAKE_LATENCY_JITTER, FAKE_LATENCY_JITTER)))
+    if throttle_random.random() < FAKE_429_RATE:
+        calls["throttled"]+= 1
+        return JSONResponse({"error": "Too many requests"}, status_code=429, headers={"Retry-After": FAKE_RETRY_AFTER})
+
+    return None
+
+@app.get("/v2/agendas")
+async def agendas(request: Request):
+    response = await fake_delay("agendas")
+    if response is not None:
+        return response
+    uids = [int(uid) for uid in request.query_params.getlist("uid[]")]
+    slugs = request.query_params.getlist("slug[]")
+    search = request.query_params.get("search")
+    if uids:
+        items = [fake_agenda(uid) for uid in uids if fake_agenda_exists(uid)]
+    elif slugs:
+        items = [fake_agenda(int(slug.rpartition("-")[2])) for slug in slugs if slug.rpartition("-")[2].isdigit() and fake_agenda_exists(int(slug.rpartition("-")[2]))]
+    else:
+        items = [fake_agenda(uid) for uid in range(1, FAKE_AGENDAS + 1) if fake_agenda_exists(uid) and (not search or search in f"Agenda {uid}")]
+    result, page = fake_page(items, request)
+
+    return {"agendas": page, **result}
+
+@app.get("/v2/agendas/{agenda_uid}")
+async def agenda(agenda_uid: int):
+    response = await fake_delay("agenda")
+    if response is not None:
+        return response
+    if not fake_agenda_exists(agenda_uid):
+        calls["not_found"]+= 1
+        return JSONResponse({"error": "Agenda not found"}, status_code=404)
+
+    return fake_agenda(agenda_uid)
+
+@app.get("/v2/agendas/{agenda_uid}/events")
+async def events(request: Request, agenda_uid: int):
+    response = await fake_delay("events")
+    if response is not None:
+        return response
+    if not fake_agenda_exists(agenda_uid):
+        calls["not_found"]+= 1
+        return JSONResponse({"error": "Agenda not found"}, status_code=404)
+    result, page = fake_page(fake_events(agenda_uid), request)
+
+    return {"events": page, **result}
+
+# Calls received, by kind
+@app.get("/_calls")
+async def calls_get():
+    return dict(calls)
@@ -7,40 +7,100 @@ load_dotenv()
 
 # Base directory
 BASE_FOLDER = Path(__file__).resolve().parent.parent.parent.parent
+# Root of data, tmp and log directories : the repository by default, a scratch directory for benchmarks
+DATA_ROOT_FOLDER = os.getenv("OPENAGENDA_DATA_ROOT", str(BASE_FOLDER))
 
 # Data directories
-DATA_FOLDER = f"{BASE_FOLDER}/data/openagenda"
-TMP_FOLDER = f"{BASE_FOLDER}/tmp/openagenda"
-LOG_FOLDER = f"{BASE_FOLDER}/log/openagenda"
+DATA_FOLDER = f"{DATA_ROOT_FOLDER}/data/openagenda"
+TMP_FOLDER = f"{DATA_ROOT_FOLDER}/tmp/openagenda"
+LOG_FOLDER = f"{DATA_ROOT_FOLDER}/log/openagenda"
 EVENTS_FOLDER = f"{DATA_FOLDER}/events"
+BACKFILL_FOLDER = f"{DATA_FOLDER}/backfill"
 QUERIES_FOLDER = f"{TMP_FOLDER}/queries"
 
 # Data files
-EVENTS_STORE_TPL = f"{EVENTS_FOLDER}/[[agenda_uid]].json"
+BACKFILL_CHECKPOINT_TPL = f"{BACKFILL_FOLDER}/[[agenda_uid]].json"
 
 # Ensure directories exist
 os.makedirs(DATA_FOLDER, exist_ok=True)
 os.makedirs(TMP_FOLDER, exist_ok=True)
 os.makedirs(LOG_FOLDER, exist_ok=True)
 os.makedirs(EVENTS_FOLDER, exist_ok=True)
+os.makedirs(BACKFILL_FOLDER, exist_ok=True)
 os.makedirs(QUERIES_FOLDER, exist_ok=True)
 
 # Data files
-AGENDAS_STORE = f"{DATA_FOLDER}/agendas.json"
+AGENDAS_STORE = f"{DATA_FOLDER}/agendas.json"  # Former agendas store, migrated into AGENDAS_DB
+AGENDAS_DB = f"{DATA_FOLDER}/agendas.sqlite3"
+EVENTS_INDEX_DB = f"{DATA_FOLDER}/events_index.sqlite3"  # Events of all agendas, indexed for search
 
 # URL templates
 OPENAGENDA_PUBLIC_KEY = os.getenv("OPENAGENDA_PUBLIC_KEY")
-OPENAGENDA_SPEED_LIMIT = 1 # openAgenda max query frequency
+OPENAGENDA_SPEED_LIMIT = float(os.getenv("OPENAGENDA_SPEED_LIMIT", "1")) # openAgenda max query frequency
+OPENAGENDA_BURST = int(os.getenv("OPENAGENDA_BURST", "1"))  # Queries allowed back to back before throttling
+OPENAGENDA_LIMITER_BACKEND = os.getenv("OPENAGENDA_LIMITER_BACKEND", "memory")  # "memory" : per worker, "file" : shared by all workers
+OPENAGENDA_LIMITER_FILE = os.getenv("OPENAGENDA_LIMITER_FILE", f"{TMP_FOLDER}/limiter.state")  # Use a /dev/shm path to share it in memory
+# Share of the queries budget of each priority class, in priority order : interactive cache misses, pagination continuations, background refresh and backfill
+# All three classes are required, with shares > 0 ; invalid shares fall back to the default ones
+OPENAGENDA_PRIORITY_SHARES_DEFAULT = "interactive:0.6,pagination:0.3,background:0.1"
+OPENAGENDA_PRIORITY_SHARES = os.getenv("OPENAGENDA_PRIORITY_SHARES", OPENAGENDA_PRIORITY_SHARES_DEFAULT)
+OPENAGENDA_MAX_RETRIES = 2  # Retries of a query throttled by openAgenda (429)
+OPENAGENDA_RETRY_AFTER_DEFAULT = 5  # Wait after a 429 without Retry-After header, in seconds
 OPENAGENDA_QUERY_SIZE = 100  # Default size for queries
 OPENAGENDA_MAX_PAGES = 10  # Maximum number of pages to fetch
-URL_TPL_START = f"https://api.openagenda.com/v2/agendas"
+AGENDAS_BATCH_WINDOW = float(os.getenv("AGENDAS_BATCH_WINDOW", "0.02"))  # Agendas details misses are collected during this window, in seconds, then queried together
+# HTTP client parameters : one keep-alive connection pool shared by all upstream queries
+OPENAGENDA_HTTP_TIMEOUT = float(os.getenv("OPENAGENDA_HTTP_TIMEOUT", "15"))  # Read / write / pool timeout, in seconds
+OPENAGENDA_HTTP_CONNECT_TIMEOUT = float(os.getenv("OPENAGENDA_HTTP_CONNECT_TIMEOUT", "5"))  # Connect timeout, in seconds
+OPENAGENDA_HTTP_MAX_CONNECTIONS = int(os.getenv("OPENAGENDA_HTTP_MAX_CONNECTIONS", "10"))
+OPENAGENDA_HTTP_MAX_KEEPALIVE = int(os.getenv("OPENAGENDA_HTTP_MAX_KEEPALIVE", "5"))
+OPENAGENDA_HTTP_KEEPALIVE_EXPIRY = 30  # Idle keep-alive connections are closed after 30 seconds
+OPENAGENDA_QUERY_TIMEOUT = float(os.getenv("OPENAGENDA_QUERY_TIMEOUT", "20"))  # Whole HTTP query deadline, in seconds, a slowly trickling response included
+# Circuit breaker, by endpoint : while open, no query goes upstream and stale cached data is served
+OPENAGENDA_CIRCUIT_FAILURES = int(os.getenv("OPENAGENDA_CIRCUIT_FAILURES", "5"))  # Consecutive failures (5xx, timeouts, network errors) opening the circuit
+OPENAGENDA_CIRCUIT_BACKOFF = float(os.getenv("OPENAGENDA_CIRCUIT_BACKOFF", "10"))  # First opening duration, in seconds, doubled at each reopening...
+OPENAGENDA_CIRCUIT_BACKOFF_MAX = float(os.getenv("OPENAGENDA_CIRCUIT_BACKOFF_MAX", "300"))  # ... up to 5 minutes
+URL_TPL_START = os.getenv("OPENAGENDA_URL_START", "https://api.openagenda.com/v2/agendas")  # Pointed to the fake OpenAgenda server by benchmarks
 URL_TPL_DEFAULT_PARAMS = f"?key={OPENAGENDA_PUBLIC_KEY}&size={OPENAGENDA_QUERY_SIZE}"
 URL_TPL_AGENDAS_SEARCH = f"{URL_TPL_START}{URL_TPL_DEFAULT_PARAMS}&search=[[search_term]]"
 URL_TPL_AGENDAS_BY_SLUG = f"{URL_TPL_START}{URL_TPL_DEFAULT_PARAMS}&slug[]=[[search_slug]]"
 URL_TPL_AGENDAS_DETAILS = f"{URL_TPL_START}/[[agenda_uid]]{URL_TPL_DEFAULT_PARAMS}"
+URL_TPL_AGENDAS_DETAILS_BATCH = f"{URL_TPL_START}{URL_TPL_DEFAULT_PARAMS}&uid[]=[[agenda_uids]]"
 URL_TPL_EVENTS_BY_AGENDA_UID = f"{URL_TPL_START}/[[agenda_uid]]/events{URL_TPL_DEFAULT_PARAMS}&sort=updatedAt.desc"
 
+# EVENTS STORE
+EVENTS_LOG_COMPACT_MIN = 1000 # Events change log is compacted into the snapshot beyond this number of changes...
+EVENTS_LOG_COMPACT_RATIO = 0.5 # ... and beyond this ratio of the agenda events
+
+# BACKFILL
+BACKFILL_RETRIES = 8 # A failed page is retried 8 times before the backfill stops in error...
+BACKFILL_RETRY_BACKOFF = 10 # ... after 10 seconds, doubled at each retry...
+BACKFILL_RETRY_BACKOFF_MAX = 600 # ... up to 10 minutes, or until OpenAgenda circuit closes again
+
+# EVENTS QUERIES
+EVENTS_QUERY_DEFAULT_LIMIT = 20  # Events per page, when paginating stored events
+EVENTS_QUERY_MAX_LIMIT = 1000
+EVENTS_NEAR_DEFAULT_RADIUS = 10  # Events near a point, in km
+EVENTS_NEAR_MAX_RADIUS = 500
+BULK_MAX_AGENDAS = 200  # Agendas per bulk query
+
 # CACHING PARAMETERS
 EVENTS_CACHING_DURATION = 86400 # Events cached for one day
+EVENTS_FULL_SYNC_DURATION = 86400*7 # Events fully synced once a week, only events updated since last sync in between
 AGENDAS_CACHING_DURATION = 86400*7 # Agendas for one week after their updatedAt field
-QUERIES_CACHING_DURATION = 3600 # Any query to OpenAgenda platform is cached for 1 hour
\ No newline at end of file
+QUERIES_CACHING_DURATION = 3600 # Any query to OpenAgenda platform is cached for 1 hour
+QUERIES_MEMORY_CACHE_MAX_ENTRIES = int(os.getenv("QUERIES_MEMORY_CACHE_MAX_ENTRIES", "512"))  # Queries kept parsed in memory, by worker
+QUERIES_MEMORY_CACHE_MAX_BYTES = int(os.getenv("QUERIES_MEMORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # Measured as JSON size
+QUERIES_FILE_CACHE_MAX_ENTRIES = int(os.getenv("QUERIES_FILE_CACHE_MAX_ENTRIES", "20000"))  # Queries kept in files, shared by all workers
+QUERIES_FILE_CACHE_MAX_BYTES = int(os.getenv("QUERIES_FILE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+QUERIES_CACHE_SWEEP_INTERVAL = 600  # Expired and least recently used queries are removed every 10 minutes
+QUERIES_STALE_DURATION = int(os.getenv("QUERIES_STALE_DURATION", str(86400)))  # Expired queries are kept one more day, served when OpenAgenda fails
+
+# BACKGROUND REFRESH
+STALE_WHILE_REVALIDATE = os.getenv("STALE_WHILE_REVALIDATE", "true").lower() == "true"  # Expired agendas and events are served at once, and refreshed in background
+REFRESHER_INTERVAL = 300 # Refresher runs every 5 minutes...
+REFRESHER_HOT_SIZE = 50 # ... renewing the 50 most accessed agendas...
+REFRESHER_AHEAD = 3600 # ... when they expire within the next hour
+REFRESHER_HOT_DECAY = 0.9 # Access counts decay at each refresher run, recent accesses weigh more
+HOT_AGENDAS_STORE = f"{DATA_FOLDER}/hot_agendas.json"
+REFRESHER_LOCK = f"{TMP_FOLDER}/refresher.lock"
@@ -0,0 +1,118 @@
+"""
+Agendas store : SQLite database keyed by agenda uid
+"""
+from mytwip.core.openagenda.sqlite_store import SqliteStore, SQL_CHUNK_SIZE
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+AGENDAS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS agendas (
+    uid INTEGER PRIMARY KEY,
+    slug TEXT,
+    cached_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS agendas_slug ON agendas (slug);
+CREATE INDEX IF NOT EXISTS agendas_cached_at ON agendas (cached_at);
+CREATE TABLE IF NOT EXISTS events_sync (
+    agenda_uid INTEGER PRIMARY KEY,
+    high_water_mark TEXT,
+    full_synced_at REAL NOT NULL
+);
+"""
+
+
+class AgendasStore(SqliteStore):
+    """
+    Agendas indexed by uid, slug and cachedAt, and events sync state of each agenda.
+    """
+    def __init__(self, path: str):
+        super().__init__(path, AGENDAS_SCHEMA)
+
+    # Get agenda by uid
+    def get(self, uid: int) -> dict|None:
+        row = self.connection().execute("SELECT data FROM agendas WHERE uid = ?", (uid,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    # Version of agenda : hash of its data, and its cachedAt. None if not stored
+    def version(self, uid: int) -> tuple[str, str|None]|None:
+        row = self.connection().execute("SELECT data, cached_at FROM agendas WHERE uid = ?", (uid,)).fetchone()
+
+        return (hashlib.md5(row[0].encode("utf-8")).hexdigest(), row[1]) if row else None
+
+    # Get agendas by slug
+    def get_by_slug(self, slug: str) -> list[dict]:
+        rows = self.connection().execute("SELECT data FROM agendas WHERE slug = ?", (slug,)).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    # Get all agendas
+    def all(self) -> list[dict]:
+        rows = self.connection().execute("SELECT data FROM agendas ORDER BY rowid").fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    # Get events sync state of agenda : most recent updatedAt among stored events, last full sync timestamp
+    def events_sync_get(self, agenda_uid: int) -> dict|None:
+        row = self.connection().execute("SELECT high_water_mark, full_synced_at FROM events_sync WHERE agenda_uid = ?", (agenda_uid,)).fetchone()
+
+        return {"high_water_mark": row[0], "full_synced_at": row[1]} if row else None
+
+    # Set events sync state of agenda
+    def events_sync_set(self, agenda_uid: int, high_water_mark: str|None, full_synced_at: float):
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO events_sync (agenda_uid, high_water_mark, full_synced_at) VALUES (?, ?, ?)",
+                (agenda_uid, high_water_mark, full_synced_at)
+            )
+
+    # Forget events sync state of agenda : next sync is a full one
+    def events_sync_delete(self, agenda_uid: int):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM events_sync WHERE agenda_uid = ?", (agenda_uid,))
+
+    # Insert new agendas, merge fields of known ones. Returns (nb updates, nb adds)
+    def upsert(self, agendas: list[dict]) -> tuple[int, int]:
+        with self.transaction() as connection:
+            result = self._upsert(connection, agendas)
+
+        return result
+
+    # One shot migration from former agendas JSON file, renamed once imported. Returns nb of imported agendas
+    def migrate_json(self, json_path: str) -> int:
+        result = 0
+        with self.transaction() as connection:
+            if os.path.exists(json_path):
+                with open(json_path, "r") as file_in:
+                    agendas = json.load(file_in)
+                self._upsert(connection, agendas)
+                os.replace(json_path, f"{json_path}.migrated")
+                result = len(agendas)
+                logger.info("agendas store : %s agendas migrated from %s", result, json_path)
+
+        return result
+
+    def _upsert(self, connection: sqlite3.Connection, agendas: list[dict]) -> tuple[int, int]:
+        new_agendas = {agenda["uid"]: agenda for agenda in agendas if agenda.get("uid") is not None}
+        uids = list(new_agendas)
+        known_agendas = {}
+        for start in range(0, len(uids), SQL_CHUNK_SIZE):
+            chunk = uids[start:start + SQL_CHUNK_SIZE]
+            rows = connection.execute(f"SELECT uid, data FROM agendas WHERE uid IN ({','.join('?' * len(chunk))})", chunk)
+            known_agendas.update({uid: json.loads(data) for uid, data in rows})
+        for uid, agenda in new_agendas.items():
+            if uid in known_agendas:
+                known_agendas[uid].update(agenda)
+                new_agendas[uid] = known_agendas[uid]
+        connection.executemany(
+            "INSERT OR REPLACE INTO agendas (uid, slug, cached_at, data) VALUES (?, ?, ?, ?)",
+            [(uid, agenda.get("slug"), agenda.get("cachedAt"), json.dumps(agenda)) for uid, agenda in new_agendas.items()]
+        )
+
+        return len(known_agendas), len(new_agendas) - len(known_agendas)
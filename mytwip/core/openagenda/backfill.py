@@ -0,0 +1,178 @@
+"""
+Resumable full backfill of agenda events, beyond OPENAGENDA_MAX_PAGES
+"""
+from mytwip.config.openagenda.settings import *
+from mytwip.core.openagenda import core
+from mytwip.core.openagenda.breaker import query_endpoint
+from mytwip.utils.common import *
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+backfill_tasks = {}
+
+# Checkpoint file path of agenda backfill
+def backfill_checkpoint_path(agenda_uid: int) -> str:
+    return BACKFILL_CHECKPOINT_TPL.replace("[[agenda_uid]]", urllib.parse.quote(str(agenda_uid)))
+
+# Load backfill checkpoint
+def backfill_checkpoint_load(agenda_uid: int) -> dict|None:
+    result = None
+    checkpoint_path = backfill_checkpoint_path(agenda_uid)
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r") as file_in:
+            result = json.load(file_in)
+
+    return result
+
+# Store backfill checkpoint, atomically
+def backfill_checkpoint_store(checkpoint: dict):
+    checkpoint["updated_at"] = get_current_utc_datetime()
+    checkpoint_path = backfill_checkpoint_path(checkpoint["agenda_uid"])
+    with open(f"{checkpoint_path}.tmp", "w") as file_out:
+        file_out.write(json.dumps(checkpoint))
+    os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+# Lock file of agenda backfill, held by its running worker
+def backfill_lock_path(agenda_uid: int) -> str:
+    return f"{backfill_checkpoint_path(agenda_uid)}.lock"
+
+# Start backfill of agenda events, or resume it from its checkpoint.
+# A backfill already running, in this worker or another one, is left as is : its checkpoint is returned, flagged already_running
+def backfill_start(agenda_uid: int, restart: bool = False) -> dict:
+    task = backfill_tasks.get(agenda_uid)
+    already_running = task is not None and not task.done()
+    with open(backfill_lock_path(agenda_uid), "w") as lock_file:
+        if not already_running:
+            # Checkpoint is written under the lock of the running backfill : never while it writes its own
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                already_running = True
+        checkpoint = backfill_checkpoint_load(agenda_uid)
+        if not already_running:
+            if checkpoint is None or restart or checkpoint["status"] == "done":
+                checkpoint = {
+                    "agenda_uid": agenda_uid,
+                    "status": "running",
+                    "after": None,
+                    "high_water_mark": None,
+                    "pages": 0,
+                    "events": 0,
+                    "total": None,
+                    "retries": 0,
+                    "started_at": get_current_utc_datetime(),
+                    "started_timestamp": time.time(),
+                }
+            checkpoint["status"] = "running"
+            checkpoint["retries"] = 0
+            checkpoint.pop("msg", None)
+            backfill_checkpoint_store(checkpoint)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            backfill_tasks[agenda_uid] = asyncio.ensure_future(backfill_run(agenda_uid))
+    data = {**(checkpoint or {"agenda_uid": agenda_uid}), "already_running": already_running}
+    if already_running:
+        result = {"status": "success", "msg": f"Backfill of agenda uid '{agenda_uid}' is already running", "data": data}
+    else:
+        result = {"status": "success", "msg": f"Backfill of agenda uid '{agenda_uid}' started", "data": data}
+
+    return result
+
+# Resume backfills interrupted by a shutdown or a crash
+def backfill_resume_all() -> list[int]:
+    result = []
+    for filename in os.listdir(BACKFILL_FOLDER):
+        if filename.endswith(".json"):
+            with open(f"{BACKFILL_FOLDER}/{filename}", "r") as file_in:
+                checkpoint = json.load(file_in)
+            if checkpoint.get("status") == "running":
+                backfill_start(checkpoint["agenda_uid"])
+                result.append(checkpoint["agenda_uid"])
+
+    return result
+
+# Stop running backfills, their checkpoints stay resumable
+def backfill_stop_all():
+    for task in backfill_tasks.values():
+        task.cancel()
+
+# Walk the whole after[] cursors chain, appending each page to events store
+async def backfill_run(agenda_uid: int):
+    # One worker only per agenda backfill
+    lock_file = open(backfill_lock_path(agenda_uid), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.info("backfill of agenda %s already running in another worker", agenda_uid)
+        lock_file.close()
+        return
+
+    checkpoint = backfill_checkpoint_load(agenda_uid)
+    try:
+        query_url = URL_TPL_EVENTS_BY_AGENDA_UID.replace("[[agenda_uid]]", urllib.parse.quote(str(agenda_uid)))
+        while checkpoint["status"] == "running":
+            after = checkpoint["after"]
+            page_query_url = query_url if after is None else f"{query_url}&after[]={after[0]}&after[]={after[1]}"
+            page_result = await core.openagenda_query(page_query_url, "events", cache=False, priority=core.PRIORITY_BACKGROUND)
+            events = page_result["data"].get("events", []) if page_result["status"] == "success" else []
+            if page_result["status"] != "success":
+                await backfill_retry(checkpoint, page_result.get("msg"), query_url)
+            # Appended out of the event loop : the cost of a page does not grow with the agenda
+            elif not await asyncio.to_thread(core.events_append, agenda_uid, events):
+                await backfill_retry(checkpoint, "Error during events append", query_url)
+            else:
+                if checkpoint["high_water_mark"] is None and events:
+                    checkpoint["high_water_mark"] = events[0].get("updatedAt")
+                after = page_result["data"].get("after")
+                checkpoint.pop("msg", None)
+                checkpoint.update({
+                    "after": after,
+                    "retries": 0,
+                    "pages": checkpoint["pages"] + 1,
+                    "events": checkpoint["events"] + len(events),
+                    "total": page_result["data"].get("total", checkpoint["total"]),
+                })
+                if not events or not isinstance(after, list) or len(after) != 2:
+                    checkpoint["status"] = "done"
+                    await asyncio.to_thread(core.events_compact, agenda_uid)
+                    core.agendas_db.events_sync_set(agenda_uid, checkpoint["high_water_mark"], checkpoint["started_timestamp"])
+            backfill_checkpoint_store(checkpoint)
+        logger.info("backfill of agenda %s : %s after %s pages / %s events", agenda_uid, checkpoint["status"], checkpoint["pages"], checkpoint["events"])
+    except Exception as e:
+        logger.error("Error during backfill of agenda %s : %s", agenda_uid, e)
+        checkpoint.update({"status": "error", "msg": str(e)})
+        backfill_checkpoint_store(checkpoint)
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+# Wait before retrying the failed page, at least until OpenAgenda circuit closes again. Stops backfill in error after BACKFILL_RETRIES
+async def backfill_retry(checkpoint: dict, msg: str|None, query_url: str):
+    retries = checkpoint.get("retries", 0)
+    if retries >= BACKFILL_RETRIES:
+        checkpoint.update({"status": "error", "msg": msg})
+    else:
+        backoff = min(BACKFILL_RETRY_BACKOFF * 2 ** retries, BACKFILL_RETRY_BACKOFF_MAX)
+        backoff = max(backoff, core.openagenda_breakers.get(query_endpoint(query_url)).retry_in())
+        checkpoint.update({"retries": retries + 1, "msg": msg})
+        logger.warning("backfill of agenda %s : page failed (%s), retry %s in %ss", checkpoint["agenda_uid"], msg, retries + 1, round(backoff))
+        backfill_checkpoint_store(checkpoint)
+        await asyncio.sleep(backoff)
+
+# Backfill progress of agenda
+def backfill_status(agenda_uid: int) -> dict:
+    checkpoint = backfill_checkpoint_load(agenda_uid)
+    if checkpoint is None:
+        result = {"status": "failure", "msg": f"No backfill for agenda uid '{agenda_uid}'", "data": None}
+    else:
+        task = backfill_tasks.get(agenda_uid)
+        checkpoint["in_this_worker"] = task is not None and not task.done()
+        result = {"status": "success", "msg": f"Backfill of agenda uid '{agenda_uid}' is {checkpoint['status']}", "data": checkpoint}
+
+    return result
@@ -0,0 +1,110 @@
+"""
+Circuit breakers of queries to OpenAgenda platform, one per endpoint
+"""
+import logging
+import re
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Closed : queries go upstream, consecutive failures are counted. After failure_threshold of them the circuit opens :
+    no query goes upstream for backoff seconds, doubled at each reopening up to backoff_max.
+    Then half open : a single probe query goes upstream, closing the circuit on success, reopening it on failure.
+    State is held by each worker process.
+    """
+    def __init__(self, endpoint: str, failure_threshold: int, backoff: float, backoff_max: float):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.openings = 0  # Consecutive openings, for backoff
+        self.opened_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    # May a query go upstream now ? In half open state, only the first caller gets to probe
+    def allow(self) -> bool:
+        result = True
+        with self.lock:
+            if self.state == CIRCUIT_OPEN and time.time() >= self.opened_until:
+                self.state = CIRCUIT_HALF_OPEN
+            if self.state == CIRCUIT_OPEN or (self.state == CIRCUIT_HALF_OPEN and self.probing):
+                result = False
+            elif self.state == CIRCUIT_HALF_OPEN:
+                self.probing = True
+
+        return result
+
+    # Outcome of an allowed query : True if upstream answered, False if it failed, None if the query was cancelled
+    def record(self, success: bool|None):
+        with self.lock:
+            if success is None:
+                self.probing = False
+            elif success:
+                if self.state != CIRCUIT_CLOSED:
+                    logger.warning("circuit %s closed", self.endpoint)
+                self.state = CIRCUIT_CLOSED
+                self.failures = 0
+                self.openings = 0
+                self.probing = False
+            else:
+                self.failures+= 1
+                if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+                    self._open()
+
+    # Seconds left before next probe, 0 if closed
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_until - time.time()) if self.state != CIRCUIT_CLOSED else 0.0
+
+    def stats_get(self) -> dict:
+        with self.lock:
+            result = {"state": self.state, "failures": self.failures, "openings": self.openings, "retry_in": round(self.retry_in(), 3)}
+
+        return result
+
+    def _open(self):
+        backoff = min(self.backoff * 2 ** self.openings, self.backoff_max)
+        self.state = CIRCUIT_OPEN
+        self.openings+= 1
+        self.opened_until = time.time() + backoff
+        self.probing = False
+        logger.warning("circuit %s open for %ss after %s failures", self.endpoint, backoff, self.failures)
+
+
+class CircuitBreakers:
+    """
+    Circuit breakers by endpoint, created on first use
+    """
+    def __init__(self, failure_threshold: int, backoff: float, backoff_max: float):
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, endpoint: str) -> CircuitBreaker:
+        with self.lock:
+            breaker = self.breakers.get(endpoint)
+            if breaker is None:
+                breaker = self.breakers[endpoint] = CircuitBreaker(endpoint, self.failure_threshold, self.backoff, self.backoff_max)
+
+        return breaker
+
+    def stats_get(self) -> dict:
+        return {endpoint: breaker.stats_get() for endpoint, breaker in list(self.breakers.items())}
+
+
+# Endpoint of a query : URL path with uids replaced, such as /v2/agendas/{uid}/events
+def query_endpoint(query_url: str) -> str:
+    return re.sub(r"/\d+(?=/|$)", "/{uid}", urllib.parse.urlsplit(query_url).path)
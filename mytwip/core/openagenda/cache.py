@@ -0,0 +1,77 @@
+"""
+In memory cache tier
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class MemoryCache:
+    """
+    LRU cache bounded by entries count and by size, with per entry expiration.
+    Entries size is given by the caller, typically the length of their JSON serialization.
+    """
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires_at, size, value), least recently used first
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    # Get value if cached and not expired
+    def get(self, key: str):
+        result = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                self._remove(key)
+                self.stats["expirations"]+= 1
+                entry = None
+            if entry is None:
+                self.stats["misses"]+= 1
+            else:
+                self.entries.move_to_end(key)
+                self.stats["hits"]+= 1
+                result = entry[2]
+
+        return result
+
+    # Cache value until expires_at timestamp, evicting least recently used entries beyond bounds
+    def set(self, key: str, value, size: int, expires_at: float):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if size > self.max_bytes or expires_at <= time.time():
+                return
+            self.entries[key] = (expires_at, size, value)
+            self.bytes+= size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.stats["evictions"]+= 1
+
+    def delete(self, key: str):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    # Remove expired entries, or all entries if forced
+    def purge(self, force: bool = False):
+        with self.lock:
+            now = time.time()
+            keys = [key for key, entry in self.entries.items() if force or entry[0] <= now]
+            for key in keys:
+                self._remove(key)
+            if not force:
+                self.stats["expirations"]+= len(keys)
+
+    def stats_get(self) -> dict:
+        with self.lock:
+            result = dict(self.stats)
+            result.update({"entries": len(self.entries), "bytes": self.bytes})
+
+        return result
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key)
+        self.bytes-= entry[1]
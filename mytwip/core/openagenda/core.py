@@ -4,47 +4,143 @@ For utils
 from mytwip.config.openagenda.settings import *
 from mytwip.core.openagenda.core import *
 from mytwip.utils.common import *
+from mytwip.core.openagenda.limiter import TokenBucket, PriorityScheduler, bucket_backend, priority_shares, retry_after_seconds
+from mytwip.core.openagenda.cache import MemoryCache
+from mytwip.core.openagenda.query_store import QueryFileCache
+from mytwip.core.openagenda.agendas_store import AgendasStore
+from mytwip.core.openagenda.events_store import EventsStore
+from mytwip.core.openagenda.events_index import EventsIndex, EVENTS_TEXT_FIELDS
+from mytwip.core.openagenda.breaker import CircuitBreakers, query_endpoint
+from mytwip.utils.metrics import Counter as MetricsCounter, Histogram
+from mytwip.utils.tracing import span
+from collections import Counter
 import logging
 import urllib.parse
-import requests
+import httpx
+import asyncio
 import time
 import copy
+import fcntl
 import hashlib
+import sqlite3
 
-openagenda_last_access = None
+openagenda_client = None
+openagenda_limiter = TokenBucket(1 / OPENAGENDA_SPEED_LIMIT, OPENAGENDA_BURST, bucket_backend(OPENAGENDA_LIMITER_BACKEND, OPENAGENDA_LIMITER_FILE))
+openagenda_scheduler = PriorityScheduler(openagenda_limiter, priority_shares(OPENAGENDA_PRIORITY_SHARES, OPENAGENDA_PRIORITY_SHARES_DEFAULT))
+openagenda_breakers = CircuitBreakers(OPENAGENDA_CIRCUIT_FAILURES, OPENAGENDA_CIRCUIT_BACKOFF, OPENAGENDA_CIRCUIT_BACKOFF_MAX)
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_PAGINATION = "pagination"
+PRIORITY_BACKGROUND = "background"
+openagenda_inflight = {}
+refresh_tasks = {}
+# Agendas details misses waiting for their batch query, by priority class : {agenda_uid: future}
+agendas_batches = {}
+agendas_hits = Counter()
+events_hits = Counter()
+openagenda_stats = {
+    "singleflight_leaders": 0,
+    "singleflight_deduplicated": 0,
+    "file_cache_hits": 0,
+    "file_cache_misses": 0,
+    "agendas_batches": 0,
+    "agendas_batched": 0,
+}
+# Metrics, rendered by /metrics
+cache_requests_metric = MetricsCounter("openagenda_cache_requests_total", "Cache lookups by tier and result", ("tier", "result"))
+upstream_duration_metric = Histogram("openagenda_upstream_duration_seconds", "OpenAgenda HTTP queries duration", ("data_type",))
+upstream_responses_metric = MetricsCounter("openagenda_upstream_responses_total", "OpenAgenda HTTP responses by status", ("status",))
+limiter_wait_metric = Histogram("openagenda_limiter_wait_seconds", "Time waited for a rate limit token", ("priority",))
+pagination_pages_metric = Histogram("openagenda_pagination_pages", "Pages fetched per paginated query", ("data_type",), buckets=(1, 2, 3, 5, 10, 20, 50, 100))
+store_duration_metric = Histogram("openagenda_store_duration_seconds", "Agendas and events stores operations duration", ("store", "operation"))
+circuit_rejected_metric = MetricsCounter("openagenda_circuit_rejected_total", "Queries not sent to OpenAgenda, circuit open", ("endpoint",))
+# Queries cache, first tier : parsed results in memory. Second tier : sharded files in QUERIES_FOLDER, swept in background
+openagenda_memory_cache = MemoryCache(QUERIES_MEMORY_CACHE_MAX_ENTRIES, QUERIES_MEMORY_CACHE_MAX_BYTES)
+openagenda_file_cache = QueryFileCache(QUERIES_FOLDER, QUERIES_FILE_CACHE_MAX_ENTRIES, QUERIES_FILE_CACHE_MAX_BYTES, QUERIES_STALE_DURATION)
+query_cache_sweeper_task = None
+# Agendas store, migrated from former agendas JSON file if any
+agendas_db = AgendasStore(AGENDAS_DB)
+agendas_db.migrate_json(AGENDAS_STORE)
+events_db = EventsStore(EVENTS_FOLDER, EVENTS_LOG_COMPACT_MIN, EVENTS_LOG_COMPACT_RATIO)
+# Events of all agendas, indexed for search, along the events store
+events_index = EventsIndex(EVENTS_INDEX_DB)
+events_index_task = None
 """
 Core utilities for OpenAgenda API
 """
+# Shared HTTP client, keeping upstream connections alive between queries
+def openagenda_client_get() -> httpx.AsyncClient:
+    global openagenda_client
+    if openagenda_client is None or openagenda_client.is_closed:
+        openagenda_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(OPENAGENDA_HTTP_TIMEOUT, connect=OPENAGENDA_HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=OPENAGENDA_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAGENDA_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=OPENAGENDA_HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+
+    return openagenda_client
+
+# Close shared HTTP client, on application shutdown
+async def openagenda_client_close():
+    global openagenda_client
+    if openagenda_client is not None:
+        await openagenda_client.aclose()
+        openagenda_client = None
+
 # Query to openAgenda API
-def openagenda_query(query_url: str, data_type="items", headers: dict = {"Accept": "application/json"}) -> dict:
-    logger.info("openagenda_query(query_url : %s)")
+# Failing endpoints are circuit broken : while open, and on any error, the newest cached result is served, however expired, flagged stale
+async def openagenda_query(query_url: str, data_type="items", headers: dict = {"Accept": "application/json"}, cache: bool = True, priority: str = PRIORITY_INTERACTIVE) -> dict:
+    logger.info("openagenda_query(query_url : %s)", query_url)
     result = {"status": "unknown", "msg": "Unkown status"}
-    query_result_data = openagenda_cached_query_load(query_url)
+    with span("cache"):
+        query_result_data = openagenda_cached_query_load(query_url) if cache else None
+    breaker = openagenda_breakers.get(query_endpoint(query_url))
     if query_result_data:
         logger.info("query was cached")
         result = {"status": "success", "msg": f"OpenAgenda query successful", "data": query_result_data, "from_cache": True}
+    elif not breaker.allow():
+        logger.warning("Query %s not sent, circuit %s open", query_url, breaker.endpoint)
+        circuit_rejected_metric.inc(endpoint=breaker.endpoint)
+        result = {"status": "error", "msg": f"OpenAgenda unavailable, retrying in {breaker.retry_in():.0f}s", "data": {}, "from_cache": False}
     else:
-        global openagenda_last_access
-        if openagenda_last_access is not None:
-            if (timestamp() - openagenda_last_access) < OPENAGENDA_SPEED_LIMIT:
-                logger.warning("OpenAgenda API rate limit reached, waiting for 1 second")
-                time.sleep(1)
-
+        # Upstream answered : True, failed : False, query cancelled : None
+        upstream_ok = None
         try:
-            response = requests.get(query_url, headers=headers)
+            for attempt in range(OPENAGENDA_MAX_RETRIES + 1):
+                with span("throttle"):
+                    limiter_wait_metric.observe(await openagenda_scheduler.acquire(priority), priority=priority)
+                with span("upstream"), upstream_duration_metric.time(data_type=data_type):
+                    response = await asyncio.wait_for(openagenda_client_get().get(query_url, headers=headers), OPENAGENDA_QUERY_TIMEOUT)
+                upstream_responses_metric.inc(status=response.status_code)
+                if response.status_code != 429:
+                    openagenda_limiter.recover()
+                    break
+                logger.warning("Query %s throttled by OpenAgenda (attempt %s)", query_url, attempt + 1)
+                openagenda_limiter.penalize(retry_after_seconds(response.headers.get("Retry-After"), OPENAGENDA_RETRY_AFTER_DEFAULT))
+            upstream_ok = response.status_code < 500
             if response.status_code == 404:
                 logger.warning("Query %s returned empty set %s : %s", query_url, response.status_code, response.text)
                 result = {"status": "success", "msg": "OpenAgenda query successful", "data": {data_type: [], "total":0}, "from_cache": False}
             elif response.status_code != 200:
                 logger.warning("Query %s returned error %s : %s", query_url, response.status_code, response.text)
-                result = {"status": "error", "msg": "Error during OpenAgenda query", "data": response.json(), "from_cache": False}
+                result = {"status": "error", "msg": "Error during OpenAgenda query", "data": openagenda_error_data(response), "from_cache": False}
             else:
                 query_result_data = response.json()
                 result = {"status": "success", "msg": f"OpenAgenda query successful", "data": query_result_data, "from_cache": False}
-                openagenda_cached_query_store(query_url, query_result_data)
+                # First page of many : the whole paginated result is cached instead, see openagenda_query_paginated
+                if cache and not openagenda_next_page(query_result_data):
+                    openagenda_cached_query_store(query_url, query_result_data)
         except Exception as e:
-            logger.error("Error during OpenAgenda query %s : %s", query_url, e)
-            result = {"status": "error", "msg": f"Error during OpenAgenda query: {str(e)}"}
+            logger.error("Error during OpenAgenda query %s : %s", query_url, repr(e))
+            upstream_ok = False
+            upstream_responses_metric.inc(status="error")
+            result = {"status": "error", "msg": f"Error during OpenAgenda query: {repr(e)}", "data": {}, "from_cache": False}
+        finally:
+            breaker.record(upstream_ok)
+    if result["status"] == "error" and cache:
+        result = openagenda_stale_query_load(query_url, result)
 
     if data_type not in result["data"] and "uid" in result["data"]:
         result["data"] = {data_type: [result["data"]], "total": 1}
@@ -55,76 +151,245 @@ def openagenda_query(query_url: str, data_type="items", headers: dict = {"Accept
     if result_to_log["data"].get("events"):
         result_to_log["data"]["events"] = f"{len(result_to_log["data"]["events"])} items"
 
-    openagenda_last_access = timestamp()
+    return result
+
+# Body of an OpenAgenda error response, JSON or not
+def openagenda_error_data(response: httpx.Response) -> dict:
+    try:
+        result = response.json()
+    except ValueError:
+        result = {"error": response.text}
+
+    return result if isinstance(result, dict) else {"error": result}
+
+# Newest cached result of a failed query, however expired, flagged stale. Failed query result if none
+def openagenda_stale_query_load(query_url: str, failed_result: dict) -> dict:
+    result = failed_result
+    cache_key = openagenda_cache_key(query_url)
+    data = None
+    try:
+        cached = openagenda_file_cache.get(cache_key, stale=True)
+        if cached is not None:
+            query_result_json, expires_at = cached
+            data = json.loads(query_result_json)
+    except (OSError, sqlite3.Error) as e:
+        logger.error("Error during stale query cache load : %s", str(e))
+    except ValueError as e:
+        openagenda_cached_query_drop(cache_key, e)
+    cache_requests_metric.inc(tier="file", result="stale" if data is not None else "miss")
+    if data is not None:
+        logger.warning("Query %s failed, serving its result expired for %ss", query_url, int(time.time() - expires_at))
+        result = {"status": "success", "msg": f"OpenAgenda unavailable, stale result : {failed_result["msg"]}", "data": data, "from_cache": True, "stale": True}
+
+    return result
+
+# Query to openAgenda API, with pagination, shared by all concurrent callers of the same query
+async def openagenda_query_paginated(query_url: str, data_type="items", stop_before: str|None = None, priority: str = PRIORITY_INTERACTIVE) -> dict:
+    async def query():
+        # Partial results of a delta sync are neither cached nor read from cache
+        cache = stop_before is None
+        query_result = await openagenda_query(query_url, data_type, cache=cache, priority=priority)
+        if query_result["status"] == "success" and openagenda_next_page(query_result["data"]):
+            query_result["data"] = await openagenda_paginate(query_result["data"], query_url, data_type, stop_before, openagenda_page_priority(priority))
+            # Pagination cut short by an upstream failure : not cached, nor taken for complete
+            if query_result["data"].get("partial"):
+                query_result["stale"] = True
+            elif cache:
+                openagenda_cached_query_store(query_url, query_result["data"])
+        return query_result
+
+    cache_key = openagenda_cache_key(query_url)
+    if stop_before is not None:
+        cache_key = f"{cache_key}:{stop_before}"
+
+    return await openagenda_singleflight(cache_key, query)
+
+# Cursor of next page, None on last page
+def openagenda_next_page(data: dict) -> list|None:
+    after = data.get("after")
+
+    return after if isinstance(after, list) and len(after) == 2 else None
+
+# Priority of next pages : after interactive first pages, unless in background
+def openagenda_page_priority(priority: str) -> str:
+    return PRIORITY_BACKGROUND if priority == PRIORITY_BACKGROUND else PRIORITY_PAGINATION
+
+# Run query once for all concurrent callers sharing the same key
+async def openagenda_singleflight(key: str, query) -> dict:
+    task = openagenda_inflight.get(key)
+    if task is None:
+        openagenda_stats["singleflight_leaders"]+= 1
+        task = asyncio.ensure_future(query())
+        openagenda_inflight[key] = task
+        task.add_done_callback(lambda done: openagenda_inflight.pop(key) if openagenda_inflight.get(key) is done else None)
+    else:
+        logger.info("query %s already in flight, waiting for it", key)
+        openagenda_stats["singleflight_deduplicated"]+= 1
+    # Shielded : a cancelled caller does not cancel the query for the other ones
+    result = await asyncio.shield(task)
+
+    return dict(result)
+
+# Run refresh in background, once at a time by key
+def refresh_schedule(key: str, refresh, *args):
+    if key not in refresh_tasks:
+        task = asyncio.ensure_future(refresh(*args))
+        refresh_tasks[key] = task
+        task.add_done_callback(lambda done: refresh_done(key, done))
+
+def refresh_done(key: str, task: asyncio.Task):
+    refresh_tasks.pop(key, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Error during background refresh %s : %s", key, task.exception())
+
+# Count access to a found agenda, for background refresh of most accessed agendas
+def agendas_hit(agenda_uid: int):
+    agendas_hits[agenda_uid]+= 1
+
+# Count access to agenda events, apart : only agendas whose events are read get their events refreshed in background
+def events_hit(agenda_uid: int):
+    events_hits[agenda_uid]+= 1
+
+# Counters of core query layer
+def openagenda_stats_get() -> dict:
+    result = {
+        "singleflight": {
+            "leaders": openagenda_stats["singleflight_leaders"],
+            "deduplicated": openagenda_stats["singleflight_deduplicated"],
+            "in_flight": len(openagenda_inflight),
+        },
+        "scheduler": openagenda_scheduler.stats_get(),
+        "circuit_breakers": openagenda_breakers.stats_get(),
+        "agendas_batches": {
+            "queries": openagenda_stats["agendas_batches"],
+            "agendas": openagenda_stats["agendas_batched"],
+            "pending": sum(len(batch) for batch in agendas_batches.values()),
+        },
+        "query_cache": {
+            "memory": openagenda_memory_cache.stats_get(),
+            "file": {
+                "hits": openagenda_stats["file_cache_hits"],
+                "misses": openagenda_stats["file_cache_misses"],
+                **openagenda_file_cache.stats_get(),
+            },
+        },
+    }
+
     return result
 
 # Handle pagination for large result sets
-def openagenda_paginate(data: dict, query_url: str, data_type: str = "items")->dict:
+# Items are expected sorted by updatedAt desc when stop_before is given : pagination stops once reaching items updated before it
+async def openagenda_paginate(data: dict, query_url: str, data_type: str = "items", stop_before: str|None = None, priority: str = PRIORITY_PAGINATION)->dict:
     logger.info(f"openagenda_paginate(agendas : {len(data.get("agendas", []))} / events : {len(data.get("events", []))}")
     items_type = "agendas" if "agendas" in data else "events" if "events" in data else None
     page_result = None
     if (items_type is None) or ("after" not in data):
         result = data
     else:
-        items = data.get(items_type)
+        # Copy : first page may be shared through the memory cache
+        items = list(data.get(items_type))
         nb_items = data.get("total", 0)
         nb_pages_to_query = min(nb_items // OPENAGENDA_QUERY_SIZE, OPENAGENDA_MAX_PAGES)
         if nb_items % OPENAGENDA_QUERY_SIZE > 0:
             nb_pages_to_query += 1
-        for page in range(2, nb_pages_to_query + 1):
-            after = data.get("after", []) if page_result is None else page_result["data"].get("after", [])
-            if len(after) != 2:
-                break
-            page_query_url = f"{query_url}&after[]={after[0]}&after[]={after[1]}"
-            page_result = openagenda_query(page_query_url, data_type)
-            if page_result["status"] == "success":
-                items+= page_result["data"].get(items_type, [])
+        nb_pages_fetched = 1
+        with span("pagination"):
+            for page in range(2, nb_pages_to_query + 1):
+                after = data.get("after", []) if page_result is None else page_result["data"].get("after", [])
+                if len(after) != 2:
+                    break
+                if stop_before is not None and items and items[-1].get("updatedAt", "") < stop_before:
+                    logger.info("pagination stopped at page %s, reaching items updated before %s", page, stop_before)
+                    break
+                page_query_url = f"{query_url}&after[]={after[0]}&after[]={after[1]}"
+                page_result = await openagenda_query(page_query_url, data_type, cache=False, priority=priority)
+                nb_pages_fetched+= 1
+                if page_result["status"] == "success":
+                    items+= page_result["data"].get(items_type, [])
 
         result = {
             items_type: items,
             "total": nb_items,
             "pages": nb_pages_to_query
         }
+        if page_result is not None and page_result["status"] != "success":
+            result["partial"] = True
+        pagination_pages_metric.observe(nb_pages_fetched, data_type=data_type)
 
     return result
 
+# Cache key of a query : same key whatever the API key and the parameters order
+def openagenda_cache_key(query_url: str) -> str:
+    url = urllib.parse.urlsplit(query_url)
+    # Stable sort : order of repeated parameters, such as after[], is kept
+    params = sorted(((name, value) for name, value in urllib.parse.parse_qsl(url.query, keep_blank_values=True) if name != "key"), key=lambda param: param[0])
+    canonical_url = f"{url.path}?{urllib.parse.urlencode(params)}"
+
+    return hashlib.md5(canonical_url.encode('utf-8')).hexdigest()
+
+# Query to openAgenda API, yielding each page result as it arrives, up to OPENAGENDA_MAX_PAGES
+async def openagenda_pages(query_url: str, data_type: str = "items", priority: str = PRIORITY_INTERACTIVE):
+    page_result = await openagenda_query(query_url, data_type, priority=priority)
+    yield page_result
+    for page in range(2, OPENAGENDA_MAX_PAGES + 1):
+        after = page_result.get("data", {}).get("after", [])
+        if page_result["status"] != "success" or not isinstance(after, list) or len(after) != 2:
+            break
+        page_result = await openagenda_query(f"{query_url}&after[]={after[0]}&after[]={after[1]}", data_type, cache=False, priority=openagenda_page_priority(priority))
+        yield page_result
+
 # Get cached query result if exists and recent
 def openagenda_cached_query_load(query_url):
-    result = None
-    md5_hash = hashlib.md5(query_url.encode('utf-8')).hexdigest()
-    file_path = f"{QUERIES_FOLDER}/{md5_hash}.json"
-    if os.path.exists(file_path):
-        last_modified = os.path.getmtime(file_path)
-        if time.time() - last_modified < QUERIES_CACHING_DURATION:
-            with open(file_path, "r") as file_in:
-                result = json.load(file_in)
-                
+    cache_key = openagenda_cache_key(query_url)
+    result = openagenda_memory_cache.get(cache_key)
+    cache_requests_metric.inc(tier="memory", result="hit" if result is not None else "miss")
+    if result is None:
+        try:
+            cached = openagenda_file_cache.get(cache_key)
+            if cached is not None:
+                query_result_json, expires_at = cached
+                result = json.loads(query_result_json)
+                openagenda_memory_cache.set(cache_key, result, len(query_result_json), expires_at)
+        except (OSError, sqlite3.Error) as e:
+            logger.error("Error during query cache load : %s", str(e))
+        except ValueError as e:
+            openagenda_cached_query_drop(cache_key, e)
+        openagenda_stats["file_cache_hits" if result is not None else "file_cache_misses"]+= 1
+        cache_requests_metric.inc(tier="file", result="hit" if result is not None else "miss")
+
     return result
 
+# Remove a cached query that does not parse : it is a cache miss, queried again
+def openagenda_cached_query_drop(cache_key: str, error: Exception):
+    logger.error("Corrupt query cache entry %s removed : %s", cache_key, str(error))
+    try:
+        openagenda_file_cache.delete(cache_key)
+    except (OSError, sqlite3.Error) as e:
+        logger.error("Error during query cache removal : %s", str(e))
+
 def openagenda_cached_query_store(query_url, query_result):
     result = False
-    md5_hash = hashlib.md5(query_url.encode('utf-8')).hexdigest()
-    file_path = f"{QUERIES_FOLDER}/{md5_hash}.json"
+    cache_key = openagenda_cache_key(query_url)
     try:
-        with open(file_path, "w") as file_out:
-            file_out.write(json.dumps(query_result))
+        query_result_json = json.dumps(query_result)
+        expires_at = time.time() + QUERIES_CACHING_DURATION
+        openagenda_memory_cache.set(cache_key, query_result, len(query_result_json), expires_at)
+        openagenda_file_cache.set(cache_key, query_result_json, expires_at)
         result = True
     except Exception as e:
         logger.error("Error during query caching : %s", str(e))
                 
     return result
 
+# Remove expired queries, and least recently used ones beyond QUERIES_FILE_CACHE_MAX_ENTRIES / _MAX_BYTES. All queries if forced
 def openagenda_cached_query_cleanup(force = False):
     result = True
-    filenames = [f"{QUERIES_FOLDER}/{filename}" for filename in os.listdir(QUERIES_FOLDER) if os.path.isfile(f"{QUERIES_FOLDER}/{filename}")]
-    if not force:
-        now = time.time()
-        filenames = [filename for filename in filenames if now - os.path.getmtime(filename) > QUERIES_CACHING_DURATION]
-    for filename in filenames:
-        try:
-            os.remove(filename)
-        except:
-            result = False
+    openagenda_memory_cache.purge(force)
+    try:
+        openagenda_file_cache.sweep(force)
+    except (OSError, sqlite3.Error) as e:
+        logger.error("Error during query cache cleanup : %s", str(e))
+        result = False
 
     result = {
         "cache_cleanup": result,
@@ -133,9 +398,27 @@ def openagenda_cached_query_cleanup(force = False):
 
     return result
 
+# Sweep queries cache periodically, out of the event loop
+async def openagenda_cached_query_sweeper():
+    try:
+        await asyncio.to_thread(openagenda_file_cache.migrate_flat)
+    except OSError as e:
+        logger.error("Error during query cache migration : %s", str(e))
+    while True:
+        await asyncio.to_thread(openagenda_cached_query_cleanup)
+        await asyncio.sleep(QUERIES_CACHE_SWEEP_INTERVAL)
+
+def openagenda_cached_query_sweeper_start():
+    global query_cache_sweeper_task
+    query_cache_sweeper_task = asyncio.ensure_future(openagenda_cached_query_sweeper())
+
+def openagenda_cached_query_sweeper_stop():
+    if query_cache_sweeper_task is not None:
+        query_cache_sweeper_task.cancel()
+
 # AGENDAS >>
 # Search agendas by search term
-def agendas_search(search_term: str) -> dict:
+async def agendas_search(search_term: str) -> dict:
     """
     Search for OpenAgenda agendas by search term
     """
@@ -150,16 +433,19 @@ def agendas_search(search_term: str) -> dict:
     else:
         # Placeholder for actual search logic
         query_url = URL_TPL_AGENDAS_SEARCH.replace("[[search_term]]", urllib.parse.quote(search_term))
-        query_result = openagenda_query(query_url, "agendas")
+        query_result = await openagenda_query_paginated(query_url, "agendas")
         if query_result["status"] == "success":
-            query_result["data"] = openagenda_paginate(query_result["data"], query_url, "agendas")
             agendas = query_result["data"].get("agendas", [])
-            agendas_update(agendas)
+            # Stale result : agendas are not stored again as fresh
+            if not query_result.get("stale"):
+                agendas_fetched(agendas)
             result = {
                 "status": "success",
                 "msg": f"Found {query_result["data"].get("total", 0)} agendas for search term '{search_term}'",
                 "data": query_result["data"]
             }
+            if query_result.get("stale"):
+                result["stale"] = True
         else:
             result = query_result
 
@@ -167,7 +453,7 @@ def agendas_search(search_term: str) -> dict:
     return result
 
 # Search agendas by slug
-def agendas_by_slug(search_slug: str) -> dict:
+async def agendas_by_slug(search_slug: str) -> dict:
     """
     Search for OpenAgenda agendas by slug
     """
@@ -183,57 +469,69 @@ def agendas_by_slug(search_slug: str) -> dict:
     else:
         # Placeholder for actual search logic
         query_url = URL_TPL_AGENDAS_BY_SLUG.replace("[[search_slug]]", urllib.parse.quote(str(search_slug)))
-        query_result = openagenda_query(query_url, "agendas")
+        query_result = await openagenda_query_paginated(query_url, "agendas")
         if query_result["status"] == "success":
-            query_result["data"] = openagenda_paginate(query_result["data"], query_url, "agendas")
             agendas = query_result["data"].get("agendas", [])
-            agendas_update(agendas)
+            if not query_result.get("stale"):
+                agendas_fetched(agendas)
             result = {
                 "status": "success",
                 "msg": f"Found {len(agendas)} agendas for search slug '{search_slug}'",
                 "data": query_result["data"]
             }
+            if query_result.get("stale"):
+                result["stale"] = True
         else:
             result = query_result
 
 
     return result
 
+# Agendas fetched by any query shape are stored by uid, so that agendas details finds them
+def agendas_fetched(agendas: list[dict]) -> bool:
+    cached_at = get_current_utc_datetime()
+    for agenda in agendas:
+        agenda.setdefault("cachedAt", cached_at)
+
+    return agendas_update(agendas) if len(agendas) else True
+
 # Search agendas details by uid
-def agendas_details(agenda_uid: int) -> dict:
+async def agendas_details(agenda_uid: int) -> dict:
     """
     Search for OpenAgenda agendas by uid
     """
     result = {"status": "unknown", "msg": "Unkown status"}
-    agendas = []
     agenda = None
     agenda_cached = False
+    agenda_stale = False
     cached_delta = None
     # Is agenda recently cached ?
-    agendas = agendas_load()
-    agendas = [agenda for agenda in agendas if agenda.get("uid") == agenda_uid]
-    if len(agendas) > 0:
-        agenda = agendas[0]
+    with span("agendas_store"), store_duration_metric.time(store="agendas", operation="read"):
+        agenda = agendas_db.get(agenda_uid)
+    if agenda is not None:
         if "cachedAt" in agenda:
             cached_delta = datetime_delta(agenda["cachedAt"])
             agenda_cached = (cached_delta < AGENDAS_CACHING_DURATION)
+            # Stale while revalidate : expired agenda is served, and refreshed in background
+            if not agenda_cached and STALE_WHILE_REVALIDATE:
+                refresh_schedule(f"agendas:{agenda_uid}", agendas_refresh, agenda_uid, PRIORITY_BACKGROUND)
+                agenda_cached = agenda_stale = True
+    cache_requests_metric.inc(tier="agendas_store", result="stale" if agenda_stale else "hit" if agenda_cached else "miss")
 
+    refresh_result = None
     if not agenda_cached:
-        agenda = None
-        query_url = URL_TPL_AGENDAS_DETAILS.replace("[[agenda_uid]]", urllib.parse.quote(str(agenda_uid)))
-        query_result = openagenda_query(query_url, "agendas")
-        if query_result["status"] == "success":
-            agendas = query_result.get("data", {}).get("agendas", [])
-            if len(agendas):
-                agendas[0]["cachedAt"] = get_current_utc_datetime()
-                agenda = agendas[0]
-                agendas_update(agendas)
-            else:
-                agenda = None
+        refresh_result = await agendas_refresh(agenda_uid)
+        if refresh_result["status"] != "success" and agenda is not None:
+            # OpenAgenda unavailable : stored agenda is served, however expired
+            agenda_stale = True
         else:
-            result = query_result
+            agenda = (refresh_result.get("data") or {}).get("agenda")
+            agenda_stale = bool(refresh_result.get("stale"))
 
-    if agenda is not None:
+    if agenda is None and refresh_result is not None and refresh_result["status"] != "success":
+        result = refresh_result
+    elif agenda is not None:
+        agendas_hit(agenda_uid)
         msg = f"Found agenda for uid '{agenda_uid}'"
         result = {
             "status": "success",
@@ -242,6 +540,8 @@ def agendas_details(agenda_uid: int) -> dict:
                 "agenda": agenda,
             }
         }
+        if agenda_stale:
+            result["stale"] = True
     else:
         msg = f"Found no agenda for uid '{agenda_uid}'"
         result = {
@@ -254,74 +554,160 @@ def agendas_details(agenda_uid: int) -> dict:
 
     return result
 
-# Load agendas data
-def agendas_load()-> list[dict]:
-    result = []
+# Fetch agenda details from OpenAgenda and store them
+async def agendas_refresh(agenda_uid: int, priority: str = PRIORITY_INTERACTIVE) -> dict:
+    # Misses arriving within AGENDAS_BATCH_WINDOW are resolved together, see agendas_batch_run
+    batch = agendas_batches.get(priority)
+    if batch is None:
+        batch = agendas_batches[priority] = {}
+        asyncio.get_running_loop().call_later(AGENDAS_BATCH_WINDOW, agendas_batch_start, priority, batch)
+    future = batch.get(agenda_uid)
+    if future is None:
+        future = batch[agenda_uid] = asyncio.get_running_loop().create_future()
+        if len(batch) >= OPENAGENDA_QUERY_SIZE:
+            agendas_batch_start(priority, batch)
+    # Shielded : a cancelled caller does not cancel the batch for the other ones
+    result = await asyncio.shield(future)
+
+    return dict(result)
+
+# Close the batch of priority class and query it, once only
+def agendas_batch_start(priority: str, batch: dict):
+    if agendas_batches.get(priority) is batch:
+        del agendas_batches[priority]
+        asyncio.ensure_future(agendas_batch_run(batch, priority))
+
+# Resolve a batch of agendas details misses with one agendas list query, then hand each waiting caller its agenda
+async def agendas_batch_run(batch: dict, priority: str):
+    results = {}
+    try:
+        if len(batch) == 1:
+            agenda_uid = next(iter(batch))
+            results[agenda_uid] = await agendas_query(agenda_uid, priority)
+        else:
+            openagenda_stats["agendas_batches"]+= 1
+            openagenda_stats["agendas_batched"]+= len(batch)
+            query_url = URL_TPL_AGENDAS_DETAILS_BATCH.replace("[[agenda_uids]]", "&uid[]=".join(urllib.parse.quote(str(agenda_uid)) for agenda_uid in batch))
+            query_result = await openagenda_query(query_url, "agendas", cache=False, priority=priority)
+            if query_result["status"] == "success":
+                agendas = query_result.get("data", {}).get("agendas", [])
+                agendas_fetched(agendas)
+                agendas_by_uid = {agenda.get("uid"): agenda for agenda in agendas}
+                for agenda_uid in batch:
+                    results[agenda_uid] = {"status": "success", "msg": f"Agenda uid '{agenda_uid}' refreshed", "data": {"agenda": agendas_by_uid.get(agenda_uid)}}
+            else:
+                results = {agenda_uid: query_result for agenda_uid in batch}
+    except Exception as e:
+        logger.error("Error during agendas batch query : %s", e)
+        results = {agenda_uid: {"status": "error", "msg": f"Error during agendas query: {str(e)}", "data": {}} for agenda_uid in batch}
+    finally:
+        for agenda_uid, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(agenda_uid, {"status": "error", "msg": "Agendas query cancelled", "data": {}}))
+
+# Query one agenda details
+async def agendas_query(agenda_uid: int, priority: str = PRIORITY_INTERACTIVE) -> dict:
+    result = {"status": "unknown", "msg": "Unkown status"}
+    query_url = URL_TPL_AGENDAS_DETAILS.replace("[[agenda_uid]]", urllib.parse.quote(str(agenda_uid)))
+    query_result = await openagenda_query_paginated(query_url, "agendas", priority=priority)
+    if query_result["status"] == "success":
+        agenda = None
+        agendas = query_result.get("data", {}).get("agendas", [])
+        if len(agendas):
+            agenda = agendas[0]
+            # Stale result : agenda is not stored again as fresh
+            if not query_result.get("stale"):
+                agenda["cachedAt"] = get_current_utc_datetime()
+                agendas_update(agendas)
+        result = {"status": "success", "msg": f"Agenda uid '{agenda_uid}' refreshed", "data": {"agenda": agenda}}
+        if query_result.get("stale"):
+            result["stale"] = True
+    else:
+        result = query_result
 
-    if os.path.exists(AGENDAS_STORE):
-        with open(AGENDAS_STORE, "r") as file_in:
-            result = json.load(file_in)
+    return result
+
+# HTTP validators of agenda : ETag, Last-Modified timestamp, freshness left in seconds. None if not stored
+def agendas_validators(agenda_uid: int) -> dict|None:
+    result = None
+    version = agendas_db.version(agenda_uid)
+    if version is not None and version[1] is not None:
+        etag, cached_at = version
+        cached_delta = datetime_delta(cached_at)
+        result = {"etag": etag, "last_modified": time.time() - cached_delta, "max_age": AGENDAS_CACHING_DURATION - cached_delta}
 
     return result
 
+# Load agendas data
+def agendas_load()-> list[dict]:
+    return agendas_db.all()
+
 # Store agendas data
 def agendas_store(agendas: list[dict]) -> bool:
     result = False
     try:
-        with open(AGENDAS_STORE, "w") as file_out:
-            file_out.write(json.dumps(agendas))
+        with store_duration_metric.time(store="agendas", operation="write"):
+            agendas_db.upsert(agendas)
         result = True
-    except IOError as e:
+    except sqlite3.Error as e:
         logger.error("Error during agendas store : %s", str(e))
 
     return result
 
 # Update agendas data
 def agendas_update(new_agendas: list[dict]) -> bool:
-    known_agendas = agendas_load()
-    known_agendas_uids = [agenda.get("uid") for agenda in known_agendas]
-    known_uids_to_indexes = {agenda.get("uid"): index for index, agenda in enumerate(known_agendas)}
-    new_uids_to_indexes = {agenda.get("uid"): index for index, agenda in enumerate(new_agendas)}
-    agendas_to_update = [agenda for agenda in new_agendas if agenda.get("uid") in known_agendas_uids]
-    nb_updates = 0
-    for agenda in agendas_to_update:
-        nb_updates+= 1
-        uid = agenda.get("uid")
-        known_index = known_uids_to_indexes[uid]
-        new_index = new_uids_to_indexes[uid]
-        known_agendas[known_index].update(new_agendas[new_index])
-    agendas_to_add = [agenda for agenda in new_agendas if agenda.get("uid") not in known_agendas_uids]
-    nb_adds = len(agendas_to_add)
-    logger.info("agendas update : nb updates : %s / nb add : %s", nb_updates, nb_adds)
-    known_agendas+= agendas_to_add
-    agendas_store(known_agendas)
+    result = False
+    try:
+        with store_duration_metric.time(store="agendas", operation="write"):
+            nb_updates, nb_adds = agendas_db.upsert(new_agendas)
+        logger.info("agendas update : nb updates : %s / nb add : %s", nb_updates, nb_adds)
+        result = True
+    except sqlite3.Error as e:
+        logger.error("Error during agendas update : %s", str(e))
+
+    return result
 
 # AGENDAS >>
 # EVENTS >>
-def events_by_agenda_uid(agenda_uid: int) -> dict:
+async def events_by_agenda_uid(agenda_uid: int) -> dict:
     """
     Search for OpenAgenda events by agenda uid
     """
     result = {"status": "unknown", "msg": "Unkown status"}
     events = None
+    events_stale = False
     # Caching
-    events_store_path = EVENTS_STORE_TPL.replace("[[agenda_uid]]", urllib.parse.quote(str(agenda_uid)))
-    last_modified = os.path.getmtime(events_store_path) if os.path.exists(events_store_path) else 0
+    last_modified = events_db.last_modified(agenda_uid)
     now = time.time()
     if now - last_modified < EVENTS_CACHING_DURATION:
+        cache_requests_metric.inc(tier="events_store", result="hit")
         events = events_load(agenda_uid)
         logger.info("events are cached")
+    elif last_modified and STALE_WHILE_REVALIDATE:
+        # Stale while revalidate : expired events are served, and refreshed in background
+        cache_requests_metric.inc(tier="events_store", result="stale")
+        events = events_load(agenda_uid)
+        events_stale = True
+        refresh_schedule(f"events:{agenda_uid}", events_refresh, agenda_uid, PRIORITY_BACKGROUND)
+        logger.info("events are stale, refreshing them in background")
     else:
-        # Placeholder for actual search logic
-        query_url = URL_TPL_EVENTS_BY_AGENDA_UID.replace("[[agenda_uid]]", urllib.parse.quote(str(agenda_uid)))
-        query_result = openagenda_query(query_url, "events")
-        if query_result["status"] == "success":
-            query_result["data"] = openagenda_paginate(query_result["data"], query_url, "events")
-            events = query_result["data"].get("events", [])
-            events_update(agenda_uid, events)
+        cache_requests_metric.inc(tier="events_store", result="miss")
+        refresh_result = await events_refresh(agenda_uid)
+        if refresh_result["status"] == "success" and not refresh_result.get("stale"):
+            events = events_load(agenda_uid)
+        elif last_modified:
+            # OpenAgenda unavailable : stored events are served, however expired
+            events = events_load(agenda_uid)
+            events_stale = True
+        elif refresh_result["status"] == "success":
+            events = refresh_result["data"].get("events", [])
+            events_stale = True
         else:
-            result = query_result
+            result = refresh_result
     if isinstance(events, list):
+        # Unknown agendas have no events : they are not refreshed in background
+        if events:
+            events_hit(agenda_uid)
         total = len(events)
         pages = total // OPENAGENDA_QUERY_SIZE
         if total % OPENAGENDA_QUERY_SIZE > 0:
@@ -335,54 +721,447 @@ def events_by_agenda_uid(agenda_uid: int) -> dict:
                 "pages": pages
             }
         }
+        if events_stale:
+            result["stale"] = True
 
 
     return result
 
+# Fetch agenda events from OpenAgenda and merge them into events store
+async def events_refresh(agenda_uid: int, priority: str = PRIORITY_INTERACTIVE) -> dict:
+    result = {"status": "unknown", "msg": "Unkown status"}
+    now = time.time()
+    # Delta sync : only events updated since last sync, until a full sync is due
+    sync = agendas_db.events_sync_get(agenda_uid) if events_db.exists(agenda_uid) else None
+    high_water_mark = None
+    if sync is not None and now - sync["full_synced_at"] < EVENTS_FULL_SYNC_DURATION:
+        high_water_mark = sync["high_water_mark"]
+    query_url = URL_TPL_EVENTS_BY_AGENDA_UID.replace("[[agenda_uid]]", urllib.parse.quote(str(agenda_uid)))
+    query_result = await openagenda_query_paginated(query_url, "events", high_water_mark, priority)
+    if query_result["status"] == "success" and query_result.get("stale"):
+        # Stale or partial result : not merged, events store and sync marks keep their own age
+        result = {"status": "success", "msg": f"OpenAgenda unavailable, stale events for agenda uid '{agenda_uid}'", "data": query_result["data"], "stale": True}
+    elif query_result["status"] == "success":
+        new_events = query_result["data"].get("events", [])
+        if high_water_mark is not None:
+            new_events = [event for event in new_events if event.get("updatedAt", "") >= high_water_mark]
+        logger.info("events %s sync : %s events fetched", "delta" if high_water_mark else "full", len(new_events))
+        events_update(agenda_uid, new_events)
+        agendas_db.events_sync_set(
+            agenda_uid,
+            max([event.get("updatedAt", "") for event in new_events] + [high_water_mark or ""]) or None,
+            sync["full_synced_at"] if high_water_mark is not None else now
+        )
+        result = {"status": "success", "msg": f"{len(new_events)} events refreshed for agenda uid '{agenda_uid}'"}
+    else:
+        result = query_result
+
+    return result
+
+# Page size and offset of events queries, from limit and cursor parameters. Raises ValueError on an invalid cursor
+def events_page_params(limit: int|None, cursor: str|None) -> tuple[int, int]:
+    limit = max(1, min(limit or EVENTS_QUERY_DEFAULT_LIMIT, EVENTS_QUERY_MAX_LIMIT))
+    offset = int(cursor) if cursor else 0
+    if offset < 0:
+        raise ValueError(f"invalid cursor '{cursor}'")
+
+    return limit, offset
+
+# Result of a page of events, with the cursor of next page
+def events_page_result(msg: str, events: list[dict], total: int, limit: int, offset: int) -> dict:
+    return {
+        "status": "success",
+        "msg": msg,
+        "data": {
+            "events": events,
+            "total": total,
+            "limit": limit,
+            "next_cursor": str(offset + limit) if offset + limit < total else None,
+        }
+    }
+
+# Page of agenda events, filtered and projected, from events store
+async def events_query(agenda_uid: int, limit: int|None = None, cursor: str|None = None, date_from: str|None = None, date_to: str|None = None, keyword: str|None = None, fields: str|None = None) -> dict:
+    """
+    Search for OpenAgenda events by agenda uid, one page at a time
+    - date_from / date_to : events with a timing overlapping [date_from, date_to[
+    - keyword : case insensitive, in title, description or keywords, any language
+    - fields : comma separated event fields to return, uid is always returned
+    - cursor : next_cursor of previous page
+    """
+    try:
+        limit, offset = events_page_params(limit, cursor)
+        timestamp_from = datetime_to_timestamp(date_from) if date_from else None
+        timestamp_to = datetime_to_timestamp(date_to) if date_to else None
+    except ValueError as e:
+        return {"status": "failure", "msg": f"Invalid parameter : {str(e)}", "data": None}
+
+    result = await events_by_agenda_uid(agenda_uid)
+    if result["status"] == "success":
+        events = result["data"]["events"]
+        if timestamp_from is not None or timestamp_to is not None:
+            events = [event for event in events if event_in_range(event, timestamp_from, timestamp_to)]
+        if keyword:
+            keyword = keyword.lower()
+            events = [event for event in events if event_has_keyword(event, keyword)]
+        page = events_fields(events[offset:offset + limit], fields)
+        result = events_page_result(f"Found {len(events)} events for agenda uid '{agenda_uid}'", page, len(events), limit, offset)
+
+    return result
+
+# Keep only comma separated fields of events, and their uid
+def events_fields(events: list[dict], fields: str|None) -> list[dict]:
+    result = events
+    if fields:
+        fields = {"uid"} | {field.strip() for field in fields.split(",")}
+        result = [{field: value for field, value in event.items() if field in fields} for event in events]
+
+    return result
+
+# Full text search of events, across all stored agendas
+async def events_search(search_term: str, agenda_uid: int|None = None, limit: int|None = None, cursor: str|None = None, fields: str|None = None) -> dict:
+    """
+    Search for stored events by text, best matches first
+    - search_term : words in title, description or keywords, any language, accents ignored. All words are required, the last one as a prefix
+    - agenda_uid : only events of this agenda
+    - fields : comma separated event fields to return, uid is always returned
+    - cursor : next_cursor of previous page
+    """
+    search_term = (search_term or "").strip()
+    try:
+        limit, offset = events_page_params(limit, cursor)
+    except ValueError as e:
+        return {"status": "failure", "msg": f"Invalid parameter : {str(e)}", "data": None}
+    if not search_term:
+        return {"status": "failure", "msg": "No search term provided", "data": None}
+
+    try:
+        with span("events_index"):
+            events, total = events_index.search(search_term, agenda_uid, limit, offset)
+        result = events_page_result(f"Found {total} events for search term '{search_term}'", events_fields(events, fields), total, limit, offset)
+    except sqlite3.Error as e:
+        logger.error("Error during events search : %s", str(e))
+        result = {"status": "error", "msg": f"Error during events search: {str(e)}", "data": None}
+
+    return result
+
+# Events of all stored agendas with a timing in a date range
+async def events_between(date_from: str, date_to: str, agenda_uid: int|None = None, limit: int|None = None, cursor: str|None = None, fields: str|None = None) -> dict:
+    """
+    Search for stored events with a timing overlapping [date_from, date_to[, by first overlapping timing
+    - date_from / date_to : ISO 8601 dates or datetimes, UTC if without offset
+    - agenda_uid : only events of this agenda
+    - fields : comma separated event fields to return, uid is always returned
+    - cursor : next_cursor of previous page
+    """
+    if not date_from or not date_to:
+        return {"status": "failure", "msg": "date_from and date_to are required", "data": None}
+    try:
+        limit, offset = events_page_params(limit, cursor)
+        timestamp_from = datetime_to_timestamp(date_from)
+        timestamp_to = datetime_to_timestamp(date_to)
+    except ValueError as e:
+        return {"status": "failure", "msg": f"Invalid parameter : {str(e)}", "data": None}
+
+    try:
+        with span("events_index"):
+            events, total = events_index.between(timestamp_from, timestamp_to, agenda_uid, limit, offset)
+        result = events_page_result(f"Found {total} events between '{date_from}' and '{date_to}'", events_fields(events, fields), total, limit, offset)
+    except sqlite3.Error as e:
+        logger.error("Error during events between query : %s", str(e))
+        result = {"status": "error", "msg": f"Error during events between query: {str(e)}", "data": None}
+
+    return result
+
+# Events of all stored agendas near a point, or in a bounding box
+async def events_near(latitude: float|None = None, longitude: float|None = None, radius: float|None = None, bbox: str|None = None, date_from: str|None = None, date_to: str|None = None, agenda_uid: int|None = None, limit: int|None = None, cursor: str|None = None, fields: str|None = None) -> dict:
+    """
+    Search for stored events by location, nearest first. Each event gets its distance, in km
+    - latitude / longitude / radius : events within radius km of the point, radius > 0, EVENTS_NEAR_DEFAULT_RADIUS by default
+    - bbox : south,west,north,east in degrees, instead of radius ; distances from latitude / longitude if given, from box center otherwise
+    - date_from / date_to : ISO 8601 dates or datetimes, only events with a timing overlapping [date_from, date_to[
+    - agenda_uid : only events of this agenda
+    - fields : comma separated event fields to return, uid is always returned
+    - cursor : next_cursor of previous page
+    """
+    try:
+        limit, offset = events_page_params(limit, cursor)
+        timestamp_from = datetime_to_timestamp(date_from) if date_from else None
+        timestamp_to = datetime_to_timestamp(date_to) if date_to else None
+        if bbox:
+            south, west, north, east = (float(value) for value in bbox.split(","))
+            if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+                raise ValueError(f"invalid bbox '{bbox}'")
+            box = (south, west, north, east)
+            if latitude is None or longitude is None:
+                latitude = (south + north) / 2
+                longitude = (west + east) / 2 if west <= east else ((west + east + 360) / 2 + 180) % 360 - 180
+            radius = None
+        elif latitude is not None and longitude is not None:
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                raise ValueError(f"invalid point '{latitude},{longitude}'")
+            if radius is not None and not radius > 0:
+                raise ValueError(f"invalid radius '{radius}', expected > 0")
+            radius = min(radius if radius is not None else EVENTS_NEAR_DEFAULT_RADIUS, EVENTS_NEAR_MAX_RADIUS)
+            box = events_index.radius_bbox(latitude, longitude, radius)
+        else:
+            raise ValueError("latitude and longitude, or bbox, are required")
+    except ValueError as e:
+        return {"status": "failure", "msg": f"Invalid parameter : {str(e)}", "data": None}
+    if (timestamp_from is None) != (timestamp_to is None):
+        return {"status": "failure", "msg": "date_from and date_to go together", "data": None}
+
+    try:
+        with span("events_index"):
+            events, total = events_index.near(latitude, longitude, box, radius, timestamp_from, timestamp_to, agenda_uid, limit, offset)
+        page = events_fields([event for event, distance in events], fields)
+        for event, (_, distance) in zip(page, events):
+            event["distance"] = round(distance, 3)
+        result = events_page_result(f"Found {total} events near '{latitude},{longitude}'", page, total, limit, offset)
+    except sqlite3.Error as e:
+        logger.error("Error during events near query : %s", str(e))
+        result = {"status": "error", "msg": f"Error during events near query: {str(e)}", "data": None}
+
+    return result
+
+# Has event a timing overlapping [timestamp_from, timestamp_to[ ? Same timings as the events index
+def event_in_range(event: dict, timestamp_from: float|None, timestamp_to: float|None) -> bool:
+    return any(
+        (timestamp_to is None or begin < timestamp_to) and (timestamp_from is None or end >= timestamp_from)
+        for begin, end in EventsIndex.event_timings(event)
+    )
+
+# Has event keyword in its title, description or keywords, in any language ? Same texts as the events index. Keyword is expected lower case
+def event_has_keyword(event: dict, keyword: str) -> bool:
+    return any(keyword in EventsIndex.event_text(event, field).lower() for field in EVENTS_TEXT_FIELDS)
+
+# Agenda details with its events
+async def agendas_with_events(agenda_uid: int, limit: int|None = None, cursor: str|None = None, date_from: str|None = None, date_to: str|None = None, keyword: str|None = None, fields: str|None = None) -> dict:
+    """
+    Search for OpenAgenda agenda by uid, with its events. Any filtering parameter returns a page of events, see events_query
+    """
+    result = {"status": "unknown", "msg": "Unkown status"}
+    events_filtered = any(param is not None for param in (limit, cursor, date_from, date_to, keyword, fields))
+    if events_filtered:
+        events_query_result = events_query(agenda_uid, limit, cursor, date_from, date_to, keyword, fields)
+    else:
+        events_query_result = events_by_agenda_uid(agenda_uid)
+    agenda_result, events_result = await asyncio.gather(agendas_details(agenda_uid), events_query_result)
+    result["status"] = "success" if (agenda_result.get("status", "failure") == "success" and events_result.get("status", "failure") == "success") else "failure"
+    result["msg"] = f"Agenda : {agenda_result.get("msg") if "msg" in agenda_result else "No msg"}. Events : {events_result.get("msg") if "msg" in events_result else "No msg"}.".replace("..", ".")
+    result["data"] = {
+        "agenda": agenda_result.get("data", {}).get("agenda", None),
+        "events" : (events_result.get("data") or {}).get("events", []),
+        "events_total": (events_result.get("data") or {}).get("total", 0),
+        "events_pages": (events_result.get("data") or {}).get("pages", 0)
+    }
+    if agenda_result.get("stale") or events_result.get("stale"):
+        result["stale"] = True
+    if events_filtered:
+        result["data"]["events_next_cursor"] = (events_result.get("data") or {}).get("next_cursor")
+
+    return result
+
+# Agendas details with their events, for many agendas, yielded in completion order
+async def agendas_with_events_bulk(agenda_uids: list[int]):
+    """
+    Cached agendas complete at once ; missing ones are fetched concurrently, the priority scheduler keeping them under OpenAgenda rate limit.
+    Each result carries its agenda_uid and its own status.
+    """
+    async def agenda_with_events(agenda_uid: int) -> dict:
+        try:
+            result = await agendas_with_events(agenda_uid)
+        except Exception as e:
+            logger.error("Error during bulk query of agenda %s : %s", agenda_uid, e)
+            result = {"status": "error", "msg": f"Error during agenda query: {str(e)}", "data": None}
+
+        return {"agenda_uid": agenda_uid, **result}
+
+    tasks = [asyncio.ensure_future(agenda_with_events(agenda_uid)) for agenda_uid in dict.fromkeys(agenda_uids)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # Client gone : pending agendas are not needed anymore
+        for task in tasks:
+            task.cancel()
+
+# Events of agenda one by one, without building the full list
+async def events_iter_by_agenda_uid(agenda_uid: int):
+    """
+    Iterate over OpenAgenda events by agenda uid.
+    Events come from the store, or from upstream pages as they arrive when the agenda was never synced.
+    Expired stored events are refreshed first, or in background with STALE_WHILE_REVALIDATE ; if OpenAgenda fails, they are streamed however expired.
+    An upstream error on a never synced agenda ends iteration with an error result {"status": "error", "msg": ...}.
+    """
+    if events_db.exists(agenda_uid):
+        events_hit(agenda_uid)
+        if time.time() - events_db.last_modified(agenda_uid) >= EVENTS_CACHING_DURATION:
+            if STALE_WHILE_REVALIDATE:
+                refresh_schedule(f"events:{agenda_uid}", events_refresh, agenda_uid, PRIORITY_BACKGROUND)
+            else:
+                await events_refresh(agenda_uid)
+        for event in events_db.iter(agenda_uid):
+            yield event
+    else:
+        high_water_mark = None
+        complete = False
+        query_url = URL_TPL_EVENTS_BY_AGENDA_UID.replace("[[agenda_uid]]", urllib.parse.quote(str(agenda_uid)))
+        try:
+            async for page_result in openagenda_pages(query_url, "events"):
+                if page_result["status"] != "success":
+                    yield page_result
+                    break
+                events = page_result["data"].get("events", [])
+                if page_result.get("stale"):
+                    # OpenAgenda unavailable : stale cached events are streamed, not stored
+                    for event in events:
+                        yield event
+                    break
+                events_update(agenda_uid, events)
+                if high_water_mark is None and events:
+                    high_water_mark = events[0].get("updatedAt")
+                for event in events:
+                    yield event
+            else:
+                agendas_db.events_sync_set(agenda_uid, high_water_mark, time.time())
+                complete = True
+        finally:
+            # Upstream failure or client gone : the pages stored so far are kept, expired, for a full sync on next read
+            if not complete and events_db.exists(agenda_uid):
+                agendas_db.events_sync_delete(agenda_uid)
+                events_db.backdate(agenda_uid, time.time() - EVENTS_CACHING_DURATION - 1)
+
+# HTTP validators of agenda events, from events store version, without loading events. None if not stored
+def events_validators(agenda_uid: int) -> dict|None:
+    result = None
+    version = events_db.version(agenda_uid)
+    if version is not None:
+        etag, last_modified = version
+        result = {"etag": etag, "last_modified": last_modified, "max_age": EVENTS_CACHING_DURATION - (time.time() - last_modified)}
+
+    return result
+
+# HTTP validators of agenda with its events
+def agendas_with_events_validators(agenda_uid: int) -> dict|None:
+    result = None
+    agenda_validators = agendas_validators(agenda_uid)
+    agenda_events_validators = events_validators(agenda_uid)
+    if agenda_validators is not None and agenda_events_validators is not None:
+        result = {
+            "etag": hashlib.md5(f"{agenda_validators["etag"]}|{agenda_events_validators["etag"]}".encode("utf-8")).hexdigest(),
+            "last_modified": max(agenda_validators["last_modified"], agenda_events_validators["last_modified"]),
+            "max_age": min(agenda_validators["max_age"], agenda_events_validators["max_age"]),
+        }
+
+    return result
+
 # Load events data
 def events_load(agenda_uid)-> list[dict]:
-    result = []
-
-    events_store_path = EVENTS_STORE_TPL.replace("[[agenda_uid]]", urllib.parse.quote(str(agenda_uid)))
-    if os.path.exists(events_store_path):
-        with open(events_store_path, "r") as file_in:
-            result = json.load(file_in)
+    with span("store_load"), store_duration_metric.time(store="events", operation="read"):
+        result = events_db.load(agenda_uid)
 
     return result
 
 # Store events data
 def events_store(agenda_uid: int, events: list[dict]) -> bool:
     result = False
-
-    events_store_path = EVENTS_STORE_TPL.replace("[[agenda_uid]]", urllib.parse.quote(str(agenda_uid)))
     try:
-        with open(events_store_path, "w") as file_out:
-            file_out.write(json.dumps(events))
+        with store_duration_metric.time(store="events", operation="write"):
+            events_db.replace(agenda_uid, events)
         result = True
     except IOError as e:
-        logger.error("Error during agendas store : %s", str(e))
+        logger.error("Error during events store : %s", str(e))
+    if result:
+        events_index_update(agenda_uid, events, replace=True)
 
     return result
 
-# Update events data
+# Update events data, storing only changed events
 def events_update(agenda_uid: int, new_events: list[dict]) -> bool:
-    known_events = events_load(agenda_uid)
-    known_events_uids = [event.get("uid") for event in known_events]
-    known_uids_to_indexes = {event.get("uid"): index for index, event in enumerate(known_events)}
-    new_uids_to_indexes = {event.get("uid"): index for index, event in enumerate(new_events)}
-    events_to_update = [event for event in new_events if event.get("uid") in known_events_uids]
-    nb_updates = 0
-    for event in events_to_update:
-        nb_updates+= 1
-        uid = event.get("uid")
-        known_index = known_uids_to_indexes[uid]
-        new_index = new_uids_to_indexes[uid]
-        known_events[known_index].update(new_events[new_index])
-    events_to_add = [event for event in new_events if event.get("uid") not in known_events_uids]
-    nb_adds = len(events_to_add)
-    logger.info("events update : nb updates : %s / nb add : %s", nb_updates, nb_adds)
-    known_events+= events_to_add
-    events_store(agenda_uid, known_events)
+    result = False
+    try:
+        with span("store_merge"), store_duration_metric.time(store="events", operation="write"):
+            nb_updates, nb_adds = events_db.update(agenda_uid, new_events)
+        logger.info("events update : nb updates : %s / nb add : %s", nb_updates, nb_adds)
+        result = True
+    except IOError as e:
+        logger.error("Error during events update : %s", str(e))
+    if result:
+        events_index_update(agenda_uid, new_events)
+
+    return result
+
+# Append events to events store, without loading stored ones, such as backfill pages. Blocking : run it in a thread
+def events_append(agenda_uid: int, events: list[dict]) -> bool:
+    result = False
+    try:
+        with store_duration_metric.time(store="events", operation="append"):
+            events_db.append(agenda_uid, events)
+        result = True
+    except IOError as e:
+        logger.error("Error during events append : %s", str(e))
+    if result:
+        events_index_update(agenda_uid, events)
+
+    return result
+
+# Merge events change log into snapshot. Blocking : run it in a thread
+def events_compact(agenda_uid: int) -> bool:
+    result = False
+    try:
+        with store_duration_metric.time(store="events", operation="compact"):
+            events_db.compact(agenda_uid)
+        result = True
+    except IOError as e:
+        logger.error("Error during events compaction : %s", str(e))
+
+    return result
+
+# Merge events into events index, recording the events store version they match
+def events_index_update(agenda_uid: int, events: list[dict], replace: bool = False) -> bool:
+    result = False
+    try:
+        version = events_db.version(agenda_uid)
+        with span("events_index"), store_duration_metric.time(store="events_index", operation="write"):
+            if replace:
+                events_index.replace(agenda_uid, events, version[0] if version else None)
+            else:
+                events_index.update(agenda_uid, events, version[0] if version else None)
+        result = True
+    except sqlite3.Error as e:
+        logger.error("Error during events index update : %s", str(e))
+
+    return result
+
+# Reindex events stores changed out of events_update : stores written before the index existed, or by a crashed worker
+def events_index_sync() -> int:
+    result = 0
+    with open(f"{EVENTS_INDEX_DB}.lock", "a") as lock_file:
+        # One worker only syncs the index
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return result
+        for agenda_uid in events_db.agenda_uids():
+            try:
+                version = events_db.version(agenda_uid)
+                if version is not None and version[0] != events_index.version(agenda_uid):
+                    with events_db.lock(agenda_uid, exclusive=False):
+                        version = events_db.version(agenda_uid)
+                        nb_events = events_index.replace(agenda_uid, events_db.iter(agenda_uid), version[0] if version else None)
+                    logger.info("events index : agenda %s reindexed, %s events", agenda_uid, nb_events)
+                    result+= 1
+            # One agenda failing does not keep the others from being indexed
+            except (OSError, ValueError, sqlite3.Error) as e:
+                logger.error("Error during events index sync of agenda %s : %s", agenda_uid, str(e))
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return result
+
+def events_index_sync_start():
+    global events_index_task
+    events_index_task = asyncio.ensure_future(asyncio.to_thread(events_index_sync))
 
 # << EVENTS
 
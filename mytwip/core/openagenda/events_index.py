@@ -0,0 +1,331 @@
+"""
+Events index : SQLite database of stored events of all agendas, with full text and timings indexes
+"""
+from mytwip.core.openagenda.sqlite_store import SqliteStore, SQL_CHUNK_SIZE
+from mytwip.utils.common import datetime_to_timestamp
+import json
+import logging
+import math
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+EVENTS_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    uid INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS agenda_events (
+    event_uid INTEGER NOT NULL,
+    agenda_uid INTEGER NOT NULL,
+    PRIMARY KEY (event_uid, agenda_uid)
+);
+CREATE INDEX IF NOT EXISTS agenda_events_agenda_uid ON agenda_events (agenda_uid);
+CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(title, description, keywords, tokenize="unicode61 remove_diacritics 2");
+CREATE TABLE IF NOT EXISTS event_timings (
+    event_uid INTEGER NOT NULL,
+    begin REAL NOT NULL,
+    end REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS event_timings_begin ON event_timings (begin);
+CREATE INDEX IF NOT EXISTS event_timings_event_uid ON event_timings (event_uid);
+CREATE TABLE IF NOT EXISTS event_long_timings (
+    event_uid INTEGER NOT NULL,
+    begin REAL NOT NULL,
+    end REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS event_long_timings_event_uid ON event_long_timings (event_uid);
+CREATE TABLE IF NOT EXISTS event_locations (
+    event_uid INTEGER PRIMARY KEY,
+    cell INTEGER NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS event_locations_cell ON event_locations (cell);
+CREATE TABLE IF NOT EXISTS indexed_agendas (
+    agenda_uid INTEGER PRIMARY KEY,
+    version TEXT
+);
+"""
+# Bumped when indexed data or schema changes : index is rebuilt from the events stores by next sync
+EVENTS_INDEX_VERSION = 5
+EVENTS_INDEX_TABLES = ("events", "agenda_events", "events_fts", "event_timings", "event_long_timings", "event_locations", "index_bounds", "indexed_agendas")
+# Timings longer than this, in seconds, are kept apart and scanned whole : overlapping timings of the others begin at most this long before a range
+LONG_TIMING_DURATION = 7 * 86400
+# Grid cells of event locations, in degrees : cell number is latitude row * GRID_COLUMNS + longitude column,
+# so that cells of a row of a bounding box are one range of cell numbers
+GRID_CELL_DEGREES = 0.1
+GRID_COLUMNS = round(360 / GRID_CELL_DEGREES)
+# Beyond this number of rows, a bounding box is read as whole rows
+GRID_MAX_ROWS = 100
+EARTH_RADIUS_KM = 6371.0
+# Multilingual event fields indexed as full text
+EVENTS_TEXT_FIELDS = ("title", "description", "keywords")
+
+
+class EventsIndex(SqliteStore):
+    """
+    Events of all agendas by uid, an event shared into many agendas being indexed once, full text indexed on title, description and keywords in all languages, accents ignored,
+    and timings indexed on begin : overlapping timings are one range scan away, bounded by LONG_TIMING_DURATION, plus the few longer ones,
+    and locations indexed on a latitude / longitude grid.
+    Updated incrementally along the events store ; version of the indexed store of each agenda tells which ones to reindex.
+    """
+    def __init__(self, path: str):
+        super().__init__(path)
+        with self.transaction() as connection:
+            if connection.execute("PRAGMA user_version").fetchone()[0] < EVENTS_INDEX_VERSION:
+                for table in EVENTS_INDEX_TABLES:
+                    connection.execute(f"DROP TABLE IF EXISTS {table}")
+                connection.execute(f"PRAGMA user_version = {EVENTS_INDEX_VERSION}")
+        self.connection().executescript(EVENTS_INDEX_SCHEMA)
+
+    # Merge new events of agenda into index, as the events store does. Returns nb of indexed events
+    def update(self, agenda_uid: int, new_events: list[dict], version: str|None = None) -> int:
+        with self.transaction() as connection:
+            result = self._update(connection, agenda_uid, new_events)
+            self._version_set(connection, agenda_uid, version)
+
+        return result
+
+    # Replace all indexed events of agenda
+    def replace(self, agenda_uid: int, events, version: str|None = None) -> int:
+        with self.transaction() as connection:
+            self._delete_agenda(connection, agenda_uid)
+            result = 0
+            chunk = []
+            for event in events:
+                chunk.append(event)
+                if len(chunk) == SQL_CHUNK_SIZE:
+                    result+= self._update(connection, agenda_uid, chunk)
+                    chunk = []
+            result+= self._update(connection, agenda_uid, chunk)
+            self._version_set(connection, agenda_uid, version)
+
+        return result
+
+    # Version of events store of agenda when it was last indexed
+    def version(self, agenda_uid: int) -> str|None:
+        row = self.connection().execute("SELECT version FROM indexed_agendas WHERE agenda_uid = ?", (agenda_uid,)).fetchone()
+
+        return row[0] if row else None
+
+    # Full text search, best matches first. Returns (events, total)
+    def search(self, query: str, agenda_uid: int|None = None, limit: int = 20, offset: int = 0) -> tuple[list[dict], int]:
+        match = self.fts_query(query)
+        where = "events_fts MATCH ?"
+        params = [match]
+        if agenda_uid is not None:
+            where+= " AND events_fts.rowid IN (SELECT event_uid FROM agenda_events WHERE agenda_uid = ?)"
+            params.append(agenda_uid)
+        connection = self.connection()
+        total = connection.execute(f"SELECT COUNT(*) FROM events_fts JOIN events ON events.uid = events_fts.rowid WHERE {where}", params).fetchone()[0]
+        rows = connection.execute(
+            f"SELECT events.data FROM events_fts JOIN events ON events.uid = events_fts.rowid WHERE {where} ORDER BY events_fts.rank LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+
+        return [json.loads(row[0]) for row in rows], total
+
+    # Events with a timing overlapping [timestamp_from, timestamp_to[, by first overlapping timing begin. Returns (events, total)
+    def between(self, timestamp_from: float, timestamp_to: float, agenda_uid: int|None = None, limit: int = 20, offset: int = 0) -> tuple[list[dict], int]:
+        connection = self.connection()
+        # Short timings beginning before timestamp_from - LONG_TIMING_DURATION cannot overlap
+        overlapping = (
+            "SELECT event_uid, begin FROM event_timings WHERE begin >= ? AND begin < ? AND end >= ?"
+            " UNION ALL SELECT event_uid, begin FROM event_long_timings WHERE begin < ? AND end >= ?"
+        )
+        params = [timestamp_from - LONG_TIMING_DURATION, timestamp_to, timestamp_from, timestamp_to, timestamp_from]
+        where = "1"
+        if agenda_uid is not None:
+            where = "event_uid IN (SELECT event_uid FROM agenda_events WHERE agenda_uid = ?)"
+            params.append(agenda_uid)
+        matches = f"SELECT event_uid, MIN(begin) AS first_begin FROM ({overlapping}) WHERE {where} GROUP BY event_uid"
+        total = connection.execute(f"SELECT COUNT(*) FROM ({matches})", params).fetchone()[0]
+        rows = connection.execute(
+            f"SELECT events.data FROM ({matches}) AS matches JOIN events ON events.uid = matches.event_uid ORDER BY matches.first_begin, matches.event_uid LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+
+        return [json.loads(row[0]) for row in rows], total
+
+    # Events located in bounding box, nearest to (latitude, longitude) first, optionally with a timing overlapping [timestamp_from, timestamp_to[.
+    # Returns ([(event, distance in km)], total)
+    def near(self, latitude: float, longitude: float, bbox: tuple[float, float, float, float], radius: float|None = None,
+             timestamp_from: float|None = None, timestamp_to: float|None = None, agenda_uid: int|None = None, limit: int = 20, offset: int = 0) -> tuple[list[tuple[dict, float]], int]:
+        south, west, north, east = bbox
+        cells = []
+        params = []
+        rows = range(self.grid_row(south), self.grid_row(north) + 1)
+        if len(rows) > GRID_MAX_ROWS:
+            # Tall box : whole rows, as one range of cells
+            cells.append("event_locations.cell BETWEEN ? AND ?")
+            params+= [rows[0] * GRID_COLUMNS, (rows[-1] + 1) * GRID_COLUMNS - 1]
+        else:
+            # Box crossing the antimeridian is split in two
+            for west_bound, east_bound in ([(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]):
+                for row in rows:
+                    cells.append("event_locations.cell BETWEEN ? AND ?")
+                    params+= [row * GRID_COLUMNS + self.grid_column(west_bound), row * GRID_COLUMNS + self.grid_column(east_bound)]
+        where = f"({' OR '.join(cells)}) AND event_locations.latitude BETWEEN ? AND ?"
+        params+= [south, north]
+        where+= " AND event_locations.longitude BETWEEN ? AND ?" if west <= east else " AND (event_locations.longitude >= ? OR event_locations.longitude <= ?)"
+        params+= [west, east]
+        if timestamp_from is not None and timestamp_to is not None:
+            where+= (
+                " AND (EXISTS (SELECT 1 FROM event_timings WHERE event_timings.event_uid = event_locations.event_uid AND event_timings.begin >= ? AND event_timings.begin < ? AND event_timings.end >= ?)"
+                " OR EXISTS (SELECT 1 FROM event_long_timings WHERE event_long_timings.event_uid = event_locations.event_uid AND event_long_timings.begin < ? AND event_long_timings.end >= ?))"
+            )
+            params+= [timestamp_from - LONG_TIMING_DURATION, timestamp_to, timestamp_from, timestamp_to, timestamp_from]
+        if agenda_uid is not None:
+            where+= " AND event_locations.event_uid IN (SELECT event_uid FROM agenda_events WHERE agenda_uid = ?)"
+            params.append(agenda_uid)
+        connection = self.connection()
+        candidates = []
+        for event_uid, event_latitude, event_longitude in connection.execute(f"SELECT event_uid, latitude, longitude FROM event_locations WHERE {where}", params):
+            distance = self.distance(latitude, longitude, event_latitude, event_longitude)
+            if radius is None or distance <= radius:
+                candidates.append((distance, event_uid))
+        candidates.sort()
+        # As SQL OFFSET : a negative offset starts at the first candidate
+        offset = max(0, offset)
+        page = candidates[offset:offset + limit]
+        events = {}
+        if page:
+            rows = connection.execute(f"SELECT uid, data FROM events WHERE uid IN ({','.join('?' * len(page))})", [event_uid for distance, event_uid in page])
+            events = {uid: json.loads(data) for uid, data in rows}
+
+        return [(events[event_uid], distance) for distance, event_uid in page if event_uid in events], len(candidates)
+
+    @staticmethod
+    def grid_row(latitude: float) -> int:
+        return math.floor((min(max(latitude, -90.0), 90.0) + 90) / GRID_CELL_DEGREES)
+
+    @staticmethod
+    def grid_column(longitude: float) -> int:
+        return min(math.floor((min(max(longitude, -180.0), 180.0) + 180) / GRID_CELL_DEGREES), GRID_COLUMNS - 1)
+
+    # Great circle distance, in km
+    @staticmethod
+    def distance(latitude_1: float, longitude_1: float, latitude_2: float, longitude_2: float) -> float:
+        phi_1, phi_2 = math.radians(latitude_1), math.radians(latitude_2)
+        delta_phi = phi_2 - phi_1
+        delta_lambda = math.radians(longitude_2 - longitude_1)
+        a = math.sin(delta_phi / 2) ** 2 + math.cos(phi_1) * math.cos(phi_2) * math.sin(delta_lambda / 2) ** 2
+
+        return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+    # Bounding box (south, west, north, east) of a circle, in degrees
+    @staticmethod
+    def radius_bbox(latitude: float, longitude: float, radius: float) -> tuple[float, float, float, float]:
+        delta_latitude = math.degrees(radius / EARTH_RADIUS_KM)
+        south, north = latitude - delta_latitude, latitude + delta_latitude
+        if south <= -90 or north >= 90:
+            # Circle around a pole : all longitudes
+            return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+        delta_longitude = math.degrees(radius / (EARTH_RADIUS_KM * math.cos(math.radians(latitude))))
+        if delta_longitude >= 180:
+            return south, -180.0, north, 180.0
+        west, east = longitude - delta_longitude, longitude + delta_longitude
+        # Wrapped around the antimeridian : west > east
+        west = west + 360 if west < -180 else west
+        east = east - 360 if east > 180 else east
+
+        return south, west, north, east
+
+    # (latitude, longitude) of event location, None if missing or invalid
+    @staticmethod
+    def event_location(event: dict) -> tuple[float, float]|None:
+        location = event.get("location")
+        try:
+            latitude, longitude = float(location["latitude"]), float(location["longitude"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        return (latitude, longitude) if -90 <= latitude <= 90 and -180 <= longitude <= 180 else None
+
+    # FTS5 query of user terms : all terms required, last one as a prefix, FTS5 syntax characters quoted away
+    @staticmethod
+    def fts_query(query: str) -> str:
+        terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+        if terms:
+            terms[-1]+= "*"
+
+        return " ".join(terms)
+
+    # Text of a multilingual field : values of all languages, lists flattened
+    @staticmethod
+    def event_text(event: dict, field: str) -> str:
+        texts = []
+        value = event.get(field)
+        values = value.values() if isinstance(value, dict) else [value]
+        for value in values:
+            texts+= value if isinstance(value, list) else [value]
+
+        return " ".join(text for text in texts if isinstance(text, str))
+
+    # (begin, end) timestamps of event timings, skipping unparsable ones
+    @staticmethod
+    def event_timings(event: dict) -> list[tuple[float, float]]:
+        result = []
+        for timing in event.get("timings") or []:
+            try:
+                begin = datetime_to_timestamp(timing["begin"])
+                end = datetime_to_timestamp(timing.get("end") or timing["begin"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            result.append((begin, max(begin, end)))
+
+        return result
+
+    def _update(self, connection: sqlite3.Connection, agenda_uid: int, new_events: list[dict]) -> int:
+        new_events = {event["uid"]: event for event in new_events if event.get("uid") is not None}
+        uids = list(new_events)
+        for start in range(0, len(uids), SQL_CHUNK_SIZE):
+            chunk = uids[start:start + SQL_CHUNK_SIZE]
+            rows = connection.execute(f"SELECT uid, data FROM events WHERE uid IN ({','.join('?' * len(chunk))})", chunk)
+            for uid, data in rows:
+                new_events[uid] = {**json.loads(data), **new_events[uid]}
+            self._delete_events(connection, chunk, keep_data=True)
+        connection.executemany("INSERT OR REPLACE INTO events (uid, data) VALUES (?, ?)", [(uid, json.dumps(event)) for uid, event in new_events.items()])
+        connection.executemany("INSERT OR IGNORE INTO agenda_events (event_uid, agenda_uid) VALUES (?, ?)", [(uid, agenda_uid) for uid in new_events])
+        connection.executemany(
+            "INSERT INTO events_fts (rowid, title, description, keywords) VALUES (?, ?, ?, ?)",
+            [(uid, *(self.event_text(event, field) for field in EVENTS_TEXT_FIELDS)) for uid, event in new_events.items()]
+        )
+        timings = [(uid, begin, end) for uid, event in new_events.items() for begin, end in self.event_timings(event)]
+        connection.executemany("INSERT INTO event_timings (event_uid, begin, end) VALUES (?, ?, ?)", [timing for timing in timings if timing[2] - timing[1] <= LONG_TIMING_DURATION])
+        connection.executemany("INSERT INTO event_long_timings (event_uid, begin, end) VALUES (?, ?, ?)", [timing for timing in timings if timing[2] - timing[1] > LONG_TIMING_DURATION])
+        locations = []
+        for uid, event in new_events.items():
+            location = self.event_location(event)
+            if location is not None:
+                locations.append((uid, self.grid_row(location[0]) * GRID_COLUMNS + self.grid_column(location[1]), *location))
+        connection.executemany("INSERT INTO event_locations (event_uid, cell, latitude, longitude) VALUES (?, ?, ?, ?)", locations)
+
+        return len(new_events)
+
+    # Remove agenda from its events : events of no other agenda are deleted
+    def _delete_agenda(self, connection: sqlite3.Connection, agenda_uid: int):
+        uids = [row[0] for row in connection.execute("SELECT event_uid FROM agenda_events WHERE agenda_uid = ?", (agenda_uid,))]
+        connection.execute("DELETE FROM agenda_events WHERE agenda_uid = ?", (agenda_uid,))
+        for start in range(0, len(uids), SQL_CHUNK_SIZE):
+            chunk = uids[start:start + SQL_CHUNK_SIZE]
+            rows = connection.execute(
+                f"SELECT uid FROM events WHERE uid IN ({','.join('?' * len(chunk))}) AND NOT EXISTS (SELECT 1 FROM agenda_events WHERE event_uid = events.uid)",
+                chunk
+            )
+            self._delete_events(connection, [row[0] for row in rows])
+
+    # Delete indexed events, or only their full text, timings and locations if keep_data
+    def _delete_events(self, connection: sqlite3.Connection, uids: list[int], keep_data: bool = False):
+        if uids:
+            placeholders = ",".join("?" * len(uids))
+            connection.execute(f"DELETE FROM events_fts WHERE rowid IN ({placeholders})", uids)
+            connection.execute(f"DELETE FROM event_timings WHERE event_uid IN ({placeholders})", uids)
+            connection.execute(f"DELETE FROM event_long_timings WHERE event_uid IN ({placeholders})", uids)
+            connection.execute(f"DELETE FROM event_locations WHERE event_uid IN ({placeholders})", uids)
+            if not keep_data:
+                connection.execute(f"DELETE FROM events WHERE uid IN ({placeholders})", uids)
+
+    def _version_set(self, connection: sqlite3.Connection, agenda_uid: int, version: str|None):
+        connection.execute("INSERT OR REPLACE INTO indexed_agendas (agenda_uid, version) VALUES (?, ?)", (agenda_uid, version))
@@ -0,0 +1,243 @@
+"""
+Events store : files of each agenda in events folder
+- snapshot : NDJSON file, one event per line, replaced atomically on compaction
+- change log : NDJSON file of changed events, appended on each update, replayed over the snapshot
+- lock file : flock, shared for reads, exclusive for writes, between threads and worker processes
+"""
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class EventsStore:
+    """
+    Per agenda events store, with atomic snapshot replacement and append-only change log.
+    Change log is compacted into the snapshot once it holds more than compact_ratio of the snapshot events.
+    Legacy JSON stores are migrated to snapshots on first write.
+    """
+    def __init__(self, folder: str, compact_min: int = 1000, compact_ratio: float = 0.5):
+        self.folder = folder
+        self.compact_min = compact_min
+        self.compact_ratio = compact_ratio
+
+    def path(self, agenda_uid: int, extension: str) -> str:
+        return f"{self.folder}/{agenda_uid}.{extension}"
+
+    @contextmanager
+    def lock(self, agenda_uid: int, exclusive: bool):
+        with open(self.path(agenda_uid, "lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Uids of agendas with stored events
+    def agenda_uids(self) -> list[int]:
+        result = set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                uid, _, extension = entry.name.partition(".")
+                if extension in ("ndjson", "json") and uid.isdigit():
+                    result.add(int(uid))
+
+        return sorted(result)
+
+    # Does agenda have stored events ?
+    def exists(self, agenda_uid: int) -> bool:
+        return os.path.exists(self.path(agenda_uid, "ndjson")) or os.path.exists(self.path(agenda_uid, "json"))
+
+    # Last update timestamp of agenda events, 0 if never stored
+    def last_modified(self, agenda_uid: int) -> float:
+        result = 0
+        for extension in ("ndjson", "log", "json"):
+            try:
+                result = max(result, os.path.getmtime(self.path(agenda_uid, extension)))
+            except OSError:
+                pass
+
+        return result
+
+    # Set last update timestamp of agenda events, such as back in time to have them refreshed
+    def backdate(self, agenda_uid: int, timestamp: float):
+        with self.lock(agenda_uid, exclusive=True):
+            for extension in ("ndjson", "log", "json"):
+                if os.path.exists(self.path(agenda_uid, extension)):
+                    os.utime(self.path(agenda_uid, extension), (timestamp, timestamp))
+
+    # Version of agenda events, from store files identity and size : a sync bringing no change keeps it.
+    # Returns (version, last update timestamp), None if never stored
+    def version(self, agenda_uid: int) -> tuple[str, float]|None:
+        parts = []
+        last_modified = 0
+        for extension in ("ndjson", "log", "json"):
+            try:
+                stat = os.stat(self.path(agenda_uid, extension))
+            except OSError:
+                continue
+            parts.append(f"{extension}:{stat.st_ino}:{stat.st_size}")
+            last_modified = max(last_modified, stat.st_mtime)
+
+        return (hashlib.md5("|".join(parts).encode("utf-8")).hexdigest(), last_modified) if parts else None
+
+    # Load all agenda events
+    def load(self, agenda_uid: int) -> list[dict]:
+        with self.lock(agenda_uid, exclusive=False):
+            events, nb_log_events = self._load(agenda_uid)
+
+        return list(events.values())
+
+    # Iterate over agenda events, without loading the snapshot in memory
+    def iter(self, agenda_uid: int):
+        snapshot_file = log_file = legacy_events = None
+        # Files are opened under lock, and stay readable after being replaced by a compaction
+        with self.lock(agenda_uid, exclusive=False):
+            if os.path.exists(self.path(agenda_uid, "ndjson")):
+                snapshot_file = open(self.path(agenda_uid, "ndjson"), "r")
+            elif os.path.exists(self.path(agenda_uid, "json")):
+                legacy_events = self._load_legacy(agenda_uid)
+            if os.path.exists(self.path(agenda_uid, "log")):
+                log_file = open(self.path(agenda_uid, "log"), "r")
+        changes = {}
+        if log_file is not None:
+            with log_file:
+                for event in self._read_ndjson(log_file):
+                    changes[event.get("uid")] = event
+        if legacy_events is not None:
+            snapshot_events = legacy_events
+        elif snapshot_file is not None:
+            snapshot_events = self._read_ndjson(snapshot_file)
+        else:
+            snapshot_events = []
+        try:
+            for event in snapshot_events:
+                yield changes.pop(event.get("uid"), event)
+            yield from changes.values()
+        finally:
+            if snapshot_file is not None:
+                snapshot_file.close()
+
+    # Merge new events into agenda events, appending only changed ones to change log. Returns (nb updates, nb adds)
+    def update(self, agenda_uid: int, new_events: list[dict]) -> tuple[int, int]:
+        nb_updates = nb_adds = 0
+        with self.lock(agenda_uid, exclusive=True):
+            events, nb_log_events = self._load(agenda_uid)
+            changed_events = []
+            for new_event in new_events:
+                uid = new_event.get("uid")
+                known_event = events.get(uid)
+                if known_event is None:
+                    nb_adds+= 1
+                    event = new_event
+                else:
+                    nb_updates+= 1
+                    event = {**known_event, **new_event}
+                    if event == known_event:
+                        continue
+                events[uid] = event
+                changed_events.append(event)
+            nb_log_events+= len(changed_events)
+            if not os.path.exists(self.path(agenda_uid, "ndjson")) or nb_log_events > max(self.compact_min, self.compact_ratio * len(events)):
+                self._compact(agenda_uid, events)
+            elif changed_events:
+                self._append(agenda_uid, changed_events)
+            else:
+                # Nothing changed : mark events as synced
+                os.utime(self.path(agenda_uid, "ndjson"))
+
+        return nb_updates, nb_adds
+
+    # Append events to change log without loading stored ones : cost of one page, whatever the agenda size.
+    # Appended events replace stored ones of the same uid as a whole. Compaction is left to update() or compact()
+    def append(self, agenda_uid: int, events: list[dict]):
+        with self.lock(agenda_uid, exclusive=True):
+            if not os.path.exists(self.path(agenda_uid, "ndjson")) and not os.path.exists(self.path(agenda_uid, "json")):
+                self._compact(agenda_uid, {event.get("uid"): event for event in events})
+            elif events:
+                self._append(agenda_uid, events)
+
+    # Merge change log into snapshot
+    def compact(self, agenda_uid: int):
+        with self.lock(agenda_uid, exclusive=True):
+            events, nb_log_events = self._load(agenda_uid)
+            if nb_log_events:
+                self._compact(agenda_uid, events)
+
+    # Replace all agenda events
+    def replace(self, agenda_uid: int, events: list[dict]):
+        with self.lock(agenda_uid, exclusive=True):
+            self._compact(agenda_uid, {event.get("uid"): event for event in events})
+
+    def _load(self, agenda_uid: int) -> tuple[dict, int]:
+        events = {}
+        nb_log_events = 0
+        if os.path.exists(self.path(agenda_uid, "ndjson")):
+            with open(self.path(agenda_uid, "ndjson"), "r") as file_in:
+                events = {event.get("uid"): event for event in self._read_ndjson(file_in)}
+        elif os.path.exists(self.path(agenda_uid, "json")):
+            events = {event.get("uid"): event for event in self._load_legacy(agenda_uid)}
+        if os.path.exists(self.path(agenda_uid, "log")):
+            with open(self.path(agenda_uid, "log"), "r") as file_in:
+                for event in self._read_ndjson(file_in):
+                    events[event.get("uid")] = event
+                    nb_log_events+= 1
+
+        return events, nb_log_events
+
+    # Load legacy JSON store. A truncated one is set aside as {uid}.json.corrupt : agenda has no stored events anymore, and gets fully synced again
+    def _load_legacy(self, agenda_uid: int) -> list[dict]:
+        legacy_path = self.path(agenda_uid, "json")
+        try:
+            with open(legacy_path, "r") as file_in:
+                result = json.load(file_in)
+        except ValueError as e:
+            logger.error("events store : corrupt legacy store %s set aside : %s", legacy_path, e)
+            try:
+                os.replace(legacy_path, f"{legacy_path}.corrupt")
+            except OSError:
+                pass
+            result = []
+        except FileNotFoundError:
+            # Set aside meanwhile by another reader
+            result = []
+
+        return result
+
+    # Read NDJSON lines, skipping a line truncated by a crash during append
+    def _read_ndjson(self, file_in):
+        for line in file_in:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("events store : skipping truncated line in %s", file_in.name)
+                continue
+            yield event
+
+    def _append(self, agenda_uid: int, events: list[dict]):
+        with open(self.path(agenda_uid, "log"), "a+b") as file_out:
+            # Terminate a line truncated by a crash, so it does not swallow the next one
+            size = file_out.seek(0, os.SEEK_END)
+            if size and os.pread(file_out.fileno(), 1, size - 1) != b"\n":
+                file_out.write(b"\n")
+            file_out.write("".join(json.dumps(event) + "\n" for event in events).encode("utf-8"))
+            file_out.flush()
+            os.fsync(file_out.fileno())
+
+    # Write snapshot atomically, then drop change log and legacy store
+    def _compact(self, agenda_uid: int, events: dict):
+        snapshot_path = self.path(agenda_uid, "ndjson")
+        with open(f"{snapshot_path}.tmp", "w") as file_out:
+            for event in events.values():
+                file_out.write(json.dumps(event) + "\n")
+            file_out.flush()
+            os.fsync(file_out.fileno())
+        os.replace(f"{snapshot_path}.tmp", snapshot_path)
+        for extension in ("log", "json"):
+            if os.path.exists(self.path(agenda_uid, extension)):
+                os.remove(self.path(agenda_uid, extension))
+        logger.info("events store : agenda %s compacted, %s events", agenda_uid, len(events))
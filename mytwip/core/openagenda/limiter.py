@@ -0,0 +1,274 @@
+"""
+Token bucket limiter and priority scheduler for queries to OpenAgenda platform
+"""
+from collections import deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import asyncio
+import logging
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows : only the memory backend can be used
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Bucket state : tokens, last refill timestamp, current rate (tokens / second), blocked until timestamp
+BUCKET_STATE_FORMAT = "dddd"
+BUCKET_STATE_SIZE = struct.calcsize(BUCKET_STATE_FORMAT)
+# Rate recovery after a 429 : each successful query gives back this part of the nominal rate
+BUCKET_RECOVERY_STEP = 0.1
+# Rate never goes below this part of the nominal rate
+BUCKET_MIN_RATE_RATIO = 0.1
+
+
+class MemoryBucketState:
+    """
+    Bucket state held by the current process
+    """
+    def __init__(self):
+        self.state = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def load(self):
+        return self.state
+
+    def save(self, state):
+        self.state = state
+
+
+class FileBucketState:
+    """
+    Bucket state held in a small file, locked with flock, shared by all worker processes.
+    Pointing the file to /dev/shm keeps the state in shared memory.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def __enter__(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return False
+
+    def load(self):
+        raw = os.pread(self.fd, BUCKET_STATE_SIZE, 0)
+        return struct.unpack(BUCKET_STATE_FORMAT, raw) if len(raw) == BUCKET_STATE_SIZE else None
+
+    def save(self, state):
+        os.pwrite(self.fd, struct.pack(BUCKET_STATE_FORMAT, *state), 0)
+
+
+class TokenBucket:
+    """
+    Token bucket, safe across threads and coroutines.
+    A caller reserves its token under lock then waits outside of it, so callers are served in arrival order.
+    Rate is halved when upstream throttles us, and recovers progressively on successful queries.
+    """
+    def __init__(self, rate: float, burst: int = 1, backend=None):
+        self.rate = rate
+        self.burst = burst
+        self.backend = backend if backend is not None else MemoryBucketState()
+        self.lock = threading.Lock()
+
+    # Apply a change to the bucket state, under thread and backend locks
+    def _update(self, change):
+        with self.lock, self.backend as backend:
+            now = time.time()
+            state = backend.load()
+            if state is None:
+                state = (float(self.burst), now, self.rate, 0.0)
+            tokens, updated_at, rate, blocked_until = state
+            tokens = min(float(self.burst), tokens + max(0.0, now - updated_at) * rate)
+            tokens, rate, blocked_until, result = change(now, tokens, rate, blocked_until)
+            backend.save((tokens, now, rate, blocked_until))
+
+        return result
+
+    # Reserve one token, returns the delay before it may be used
+    def reserve(self) -> float:
+        def change(now, tokens, rate, blocked_until):
+            tokens -= 1
+            delay = max(-tokens / rate, blocked_until - now, 0.0)
+            return tokens, rate, blocked_until, delay
+
+        return self._update(change)
+
+    # Remaining blocking delay after a Retry-After
+    def blocked_delay(self) -> float:
+        return self._update(lambda now, tokens, rate, blocked_until: (tokens, rate, blocked_until, max(blocked_until - now, 0.0)))
+
+    # Upstream throttled us : block until Retry-After and halve the rate
+    def penalize(self, retry_after: float):
+        def change(now, tokens, rate, blocked_until):
+            rate = max(rate / 2, self.rate * BUCKET_MIN_RATE_RATIO)
+            return min(tokens, 0.0), rate, max(blocked_until, now + retry_after), None
+
+        logger.warning("OpenAgenda throttling : blocking queries for %.1f seconds", retry_after)
+        self._update(change)
+
+    # Upstream accepted a query : give back part of the nominal rate
+    def recover(self):
+        def change(now, tokens, rate, blocked_until):
+            return tokens, min(self.rate, rate + self.rate * BUCKET_RECOVERY_STEP), blocked_until, None
+
+        self._update(change)
+
+    # Wait for a token, from a thread. Returns waited seconds
+    def acquire(self) -> float:
+        waited = 0.0
+        delay = self.reserve()
+        while delay > 0:
+            time.sleep(delay)
+            waited += delay
+            delay = self.blocked_delay()
+
+        return waited
+
+    # Wait for a token, from a coroutine. Returns waited seconds
+    async def acquire_async(self) -> float:
+        waited = 0.0
+        delay = self.reserve()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+            delay = self.blocked_delay()
+
+        return waited
+
+
+class PriorityScheduler:
+    """
+    Hands out bucket tokens to queued queries by priority class.
+    Each class gets its share of the tokens : among classes with queued queries, the one furthest behind its share goes first,
+    ties going to the class listed first in shares.
+    """
+    def __init__(self, bucket: TokenBucket, shares: dict):
+        self.bucket = bucket
+        self.shares = shares
+        self.queues = {name: deque() for name in shares}
+        # Virtual time of each class : tokens granted / share
+        self.virtual_times = {name: 0.0 for name in shares}
+        self.virtual_time = 0.0
+        self.stats = {name: {"granted": 0, "wait_total": 0.0, "wait_max": 0.0} for name in shares}
+        self.dispatcher = None
+        self.wakeup = None
+
+    # Wait for a token in priority class queue. Returns waited seconds
+    async def acquire(self, priority: str) -> float:
+        if self.dispatcher is None or self.dispatcher.done() or self.dispatcher.get_loop() is not asyncio.get_running_loop():
+            self.wakeup = asyncio.Event()
+            self.dispatcher = asyncio.ensure_future(self._dispatch())
+        # A class idle until now does not get credit for the time it did not use its share
+        if not self.queues[priority]:
+            self.virtual_times[priority] = max(self.virtual_times[priority], self.virtual_time)
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority].append((future, time.monotonic()))
+        self.wakeup.set()
+
+        return await future
+
+    async def _dispatch(self):
+        while True:
+            if not any(self.queues.values()):
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            await self.bucket.acquire_async()
+            # Class chosen once the token is there, so that late interactive queries still go first
+            waiting = [name for name in self.shares if self._prune(name)]
+            if not waiting:
+                continue
+            name = min(waiting, key=lambda name: self.virtual_times[name])
+            self.virtual_time = self.virtual_times[name]
+            self.virtual_times[name]+= 1 / self.shares[name]
+            future, queued_at = self.queues[name].popleft()
+            waited = time.monotonic() - queued_at
+            stats = self.stats[name]
+            stats["granted"]+= 1
+            stats["wait_total"]+= waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+            future.set_result(waited)
+
+    # Drop cancelled queries at head of class queue. Returns whether queries are still waiting
+    def _prune(self, name: str) -> bool:
+        queue = self.queues[name]
+        while queue and queue[0][0].done():
+            queue.popleft()
+
+        return bool(queue)
+
+    # Queue depth and waits of each priority class
+    def stats_get(self) -> dict:
+        result = {}
+        now = time.monotonic()
+        for name, stats in self.stats.items():
+            queue = self.queues[name]
+            result[name] = {
+                "share": self.shares[name],
+                "queued": len(queue),
+                "oldest_wait": now - queue[0][1] if queue else 0.0,
+                "granted": stats["granted"],
+                "wait_avg": stats["wait_total"] / stats["granted"] if stats["granted"] else 0.0,
+                "wait_max": stats["wait_max"],
+            }
+
+        return result
+
+
+# Build bucket state backend : "memory" for the current process, "file" to share it between workers
+def bucket_backend(backend: str, path: str):
+    result = MemoryBucketState()
+    if backend == "file":
+        if fcntl is None:
+            logger.warning("File limiter backend needs fcntl, falling back to memory backend")
+        else:
+            result = FileBucketState(path)
+
+    return result
+
+# Parse priority shares "name:share,...", in priority order. Shares missing a class of default ones, or not > 0, fall back to default ones
+def priority_shares(value: str, default: str) -> dict:
+    result = {}
+    try:
+        for item in value.split(","):
+            name, share = item.split(":")
+            result[name.strip()] = float(share)
+        missing = [name for name in (item.split(":")[0].strip() for item in default.split(",")) if name not in result]
+        if missing:
+            raise ValueError(f"missing classes {', '.join(missing)}")
+        if not all(share > 0 for share in result.values()):
+            raise ValueError("shares must be > 0")
+    except ValueError as e:
+        logger.warning("Invalid priority shares '%s' (%s), falling back to '%s'", value, e, default)
+        result = priority_shares(default, default)
+
+    return result
+
+# Parse Retry-After header, in seconds or as HTTP date
+def retry_after_seconds(header: str|None, default: float) -> float:
+    result = default
+    if header:
+        try:
+            result = float(header)
+        except ValueError:
+            try:
+                result = (parsedate_to_datetime(header) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                result = default
+
+    return max(result, 0.0)
@@ -0,0 +1,149 @@
+"""
+Queries file cache : JSON files sharded by key prefix, indexed in SQLite
+"""
+from mytwip.core.openagenda.sqlite_store import SqliteStore, SQL_CHUNK_SIZE
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+QUERIES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queries_expires_at ON queries (expires_at);
+CREATE INDEX IF NOT EXISTS queries_accessed_at ON queries (accessed_at);
+"""
+# Access time is only written back when older than this, so that hits seldom write
+ACCESS_RESOLUTION = 60
+
+
+class QueryFileCache(SqliteStore):
+    """
+    Query results in {folder}/{key[:2]}/{key}.json, bounded by entries count and total size, least recently used evicted first.
+    The index knows each entry size, expiration and last access : sweeping never lists the folder.
+    Expired entries are kept stale_duration more seconds, for get(stale=True) when OpenAgenda fails.
+    """
+    def __init__(self, folder: str, max_entries: int, max_bytes: int, stale_duration: float = 0):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_duration = stale_duration
+        super().__init__(f"{folder}/index.sqlite3", QUERIES_SCHEMA)
+
+    def path(self, key: str) -> str:
+        return f"{self.folder}/{key[:2]}/{key}.json"
+
+    # Get cached JSON and its expiration timestamp, None if not cached or expired. Expired entries still kept are returned if stale
+    def get(self, key: str, stale: bool = False) -> tuple[str, float]|None:
+        result = None
+        now = time.time()
+        row = self.connection().execute("SELECT expires_at, accessed_at FROM queries WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[0] + (self.stale_duration if stale else 0) > now:
+            expires_at, accessed_at = row
+            try:
+                with open(self.path(key), "r") as file_in:
+                    result = (file_in.read(), expires_at)
+            except FileNotFoundError:
+                self.delete(key)
+            if result is not None and now - accessed_at > ACCESS_RESOLUTION:
+                with self.transaction() as connection:
+                    connection.execute("UPDATE queries SET accessed_at = ? WHERE key = ?", (now, key))
+
+        return result
+
+    # Cache JSON until expires_at timestamp. Written to a temporary file of its own, then moved in place : workers setting the same key never publish a partial file
+    def set(self, key: str, value: str, expires_at: float):
+        file_path = self.path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=f"{key}.", suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "w") as file_out:
+                file_out.write(value)
+                file_out.flush()
+                os.fsync(file_out.fileno())
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO queries (key, size, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, len(value), expires_at, time.time())
+            )
+
+    def delete(self, key: str):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM queries WHERE key = ?", (key,))
+        self._remove([key])
+
+    # Remove entries expired for more than stale_duration, then least recently used ones beyond bounds ; all entries if forced. Returns nb of removed entries
+    def sweep(self, force: bool = False) -> int:
+        result = 0
+        while True:
+            with self.transaction() as connection:
+                if force:
+                    keys = [row[0] for row in connection.execute("SELECT key FROM queries LIMIT ?", (SQL_CHUNK_SIZE,))]
+                else:
+                    keys = [row[0] for row in connection.execute(
+                        "SELECT key FROM queries WHERE expires_at <= ? LIMIT ?", (time.time() - self.stale_duration, SQL_CHUNK_SIZE)
+                    )]
+                    if not keys:
+                        nb_entries, nb_bytes = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM queries").fetchone()
+                        if nb_entries > self.max_entries or nb_bytes > self.max_bytes:
+                            keys = self._lru_keys(connection, nb_entries, nb_bytes)
+                connection.executemany("DELETE FROM queries WHERE key = ?", [(key,) for key in keys])
+            if not keys:
+                break
+            self._remove(keys)
+            result+= len(keys)
+        if result:
+            logger.info("queries cache : %s entries removed", result)
+
+        return result
+
+    # Remove flat files of the former unsharded cache, once
+    def migrate_flat(self) -> int:
+        result = 0
+        marker_path = f"{self.folder}/.sharded"
+        if not os.path.exists(marker_path):
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(".json"):
+                        os.remove(entry.path)
+                        result+= 1
+            open(marker_path, "w").close()
+            logger.info("queries cache : %s former flat entries removed", result)
+
+        return result
+
+    def stats_get(self) -> dict:
+        nb_entries, nb_bytes = self.connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM queries").fetchone()
+
+        return {"entries": nb_entries, "bytes": nb_bytes, "max_entries": self.max_entries, "max_bytes": self.max_bytes}
+
+    # Least recently used keys to evict, to get back under bounds
+    def _lru_keys(self, connection: sqlite3.Connection, nb_entries: int, nb_bytes: int) -> list[str]:
+        result = []
+        rows = connection.execute("SELECT key, size FROM queries ORDER BY accessed_at LIMIT ?", (SQL_CHUNK_SIZE,))
+        for key, size in rows:
+            if nb_entries <= self.max_entries and nb_bytes <= self.max_bytes:
+                break
+            result.append(key)
+            nb_entries-= 1
+            nb_bytes-= size
+
+        return result
+
+    def _remove(self, keys: list[str]):
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,94 @@
+"""
+Background refresher : renews most accessed agendas before they expire, and pre-warms them at startup
+"""
+from mytwip.config.openagenda.settings import *
+from mytwip.core.openagenda import core
+from mytwip.utils.common import *
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+refresher_task = None
+refresher_lock_file = None
+
+# Merge access counts of this worker into hot agendas file, shared by all workers.
+# Returns hot agendas and hot agenda events apart, {"agendas": {agenda_uid: score}, "events": {agenda_uid: score}}, most accessed first
+def hot_agendas_flush(decay: float = 1.0) -> dict:
+    with open(f"{HOT_AGENDAS_STORE}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        stored = {}
+        if os.path.exists(HOT_AGENDAS_STORE):
+            with open(HOT_AGENDAS_STORE, "r") as file_in:
+                stored = json.load(file_in)
+            # Former file : agendas access counts only
+            if "agendas" not in stored:
+                stored = {"agendas": stored}
+        hot_agendas = {}
+        for kind, hits in (("agendas", core.agendas_hits), ("events", core.events_hits)):
+            scores = {int(agenda_uid): score * decay for agenda_uid, score in stored.get(kind, {}).items()}
+            for agenda_uid, count in hits.items():
+                scores[agenda_uid] = scores.get(agenda_uid, 0) + count
+            hits.clear()
+            hot_agendas[kind] = dict(sorted(scores.items(), key=lambda item: item[1], reverse=True)[:REFRESHER_HOT_SIZE * 4])
+        with open(f"{HOT_AGENDAS_STORE}.tmp", "w") as file_out:
+            file_out.write(json.dumps(hot_agendas))
+        os.replace(f"{HOT_AGENDAS_STORE}.tmp", HOT_AGENDAS_STORE)
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return hot_agendas
+
+# Is this worker the refresher ? Only one worker refreshes, the first one getting the lock
+def refresher_leader() -> bool:
+    global refresher_lock_file
+    if refresher_lock_file is None:
+        lock_file = open(REFRESHER_LOCK, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            refresher_lock_file = lock_file
+        except BlockingIOError:
+            lock_file.close()
+
+    return refresher_lock_file is not None
+
+# Refresh hot agendas and hot agenda events expiring soon. Agendas not stored anymore are left out
+async def refresher_run() -> dict:
+    result = {"agendas": 0, "events": 0}
+    leader = refresher_leader()
+    hot_agendas = hot_agendas_flush(REFRESHER_HOT_DECAY if leader else 1.0)
+    if leader:
+        for agenda_uid in list(hot_agendas["agendas"])[:REFRESHER_HOT_SIZE]:
+            agenda = core.agendas_db.get(agenda_uid)
+            if agenda is not None and ("cachedAt" not in agenda or datetime_delta(agenda["cachedAt"]) > AGENDAS_CACHING_DURATION - REFRESHER_AHEAD):
+                await core.agendas_refresh(agenda_uid, core.PRIORITY_BACKGROUND)
+                result["agendas"]+= 1
+        for agenda_uid in list(hot_agendas["events"])[:REFRESHER_HOT_SIZE]:
+            if time.time() - core.events_db.last_modified(agenda_uid) > EVENTS_CACHING_DURATION - REFRESHER_AHEAD:
+                await core.events_refresh(agenda_uid, core.PRIORITY_BACKGROUND)
+                result["events"]+= 1
+
+    return result
+
+# First run pre-warms the hot agendas of previous run
+async def refresher_loop():
+    while True:
+        try:
+            result = await refresher_run()
+            logger.info("refresher : %s agendas / %s events refreshed", result["agendas"], result["events"])
+        except Exception as e:
+            logger.error("Error during background refresh : %s", e)
+        await asyncio.sleep(REFRESHER_INTERVAL)
+
+def refresher_start():
+    global refresher_task
+    refresher_task = asyncio.ensure_future(refresher_loop())
+
+# Stop refresher, keeping access counts for next run pre-warm
+def refresher_stop():
+    if refresher_task is not None:
+        refresher_task.cancel()
+    hot_agendas_flush()
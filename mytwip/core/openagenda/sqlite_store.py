@@ -0,0 +1,43 @@
+"""
+SQLite stores base : agendas store, queries file cache index and events index
+"""
+from contextlib import contextmanager
+import sqlite3
+import threading
+
+# Stay under SQLite host parameters limit in IN (...) clauses
+SQL_CHUNK_SIZE = 500
+
+
+class SqliteStore:
+    """
+    SQLite database shared by all worker processes of the host.
+    One connection per thread ; WAL journal and immediate transactions keep concurrent workers safe.
+    """
+    def __init__(self, db_path: str, schema: str|None = None):
+        self.db_path = db_path
+        self.local = threading.local()
+        if schema is not None:
+            self.connection().executescript(schema)
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+
+        return connection
+
+    # Write transaction, taking the database write lock immediately
+    @contextmanager
+    def transaction(self):
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
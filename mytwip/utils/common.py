@@ -19,7 +19,8 @@ Stop perf timer
 """
 def perf_timer_stop(timer_id):
     stop_time = perf_counter()
-    timer = perf_timers[timer_id]
+    # Popped : stopped timers are not kept
+    timer = perf_timers.pop(timer_id)
     start_time = timer["start"]
     duration = stop_time - start_time
     timer.update({
@@ -37,7 +38,6 @@ def perf_timer_stop(timer_id):
         duration_str+= f"{duration_mn}mn "
     duration_str+= f"{duration:.2f}s"
     timer.update({"duration_str": duration_str})
-    perf_timers[timer_id] = timer
 
     return timer
 
@@ -83,6 +83,16 @@ def datetime_delta(test_datetime: str):
 
     return delta_seconds
 
+def datetime_to_timestamp(value: str) -> float:
+    """
+    Get timestamp of ISO 8601 date or datetime, UTC if without offset
+    """
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+
+    return parsed.timestamp()
+
 def log_queries(log_file, queries_list):
     existing_list = []
     if os.path.exists(log_file):
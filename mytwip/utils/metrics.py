@@ -0,0 +1,109 @@
+"""
+Prometheus compatible metrics : counters and histograms with labels, rendered in text exposition format.
+Metrics are held by each worker process.
+"""
+from contextlib import contextmanager
+from time import perf_counter
+import math
+import threading
+
+# Latency buckets, in seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+metrics_registry = {}
+
+
+class Counter:
+    """
+    Monotonic counter, one value per labels combination
+    """
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry[name] = self
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        for key, value in list(self.values.items()):
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets, one per labels combination
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (), buckets: tuple = DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry[name] = self
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index]+= 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    # Observe duration of the with block
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in list(self.values.items()):
+            labels = dict(zip(self.labelnames, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", {**labels, "le": f"{bound:g}"}, bucket_count
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+def metrics_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+# Sample value, exact : integers as is, floats with all their digits, so that large counters keep their precision
+def metrics_value(value: float) -> str:
+    if isinstance(value, int):
+        result = str(value)
+    elif math.isnan(value):
+        result = "NaN"
+    elif math.isinf(value):
+        result = "+Inf" if value > 0 else "-Inf"
+    else:
+        result = repr(float(value))
+
+    return result
+
+# All metrics, in Prometheus text exposition format
+def metrics_render() -> str:
+    lines = []
+    for metric in metrics_registry.values():
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            labels_str = ",".join(f'{label}="{metrics_label_value(label_value)}"' for label, label_value in labels.items())
+            lines.append(f"{name}{{{labels_str}}} {metrics_value(value)}" if labels_str else f"{name} {metrics_value(value)}")
+
+    return "\n".join(lines) + "\n"
@@ -1,10 +1,16 @@
+import hmac
+import math
 import os
+import sqlite3
+import tempfile
+import threading
 import time
+from collections import OrderedDict
 from fastapi import Security, HTTPException, Depends, Request
 from fastapi.security.api_key import APIKeyHeader
 from starlette.status import HTTP_403_FORBIDDEN, HTTP_429_TOO_MANY_REQUESTS
 from dotenv import load_dotenv
-from typing import Dict, List, Tuple
+from typing import Tuple
 
 # Load environment variables
 load_dotenv()
@@ -12,6 +18,9 @@ load_dotenv()
 # Get API key from environment variable
 API_KEY = os.getenv("API_KEY")
 API_KEY_NAME = "X-API-Key"
+# Admin key, for diagnostic features such as request profiling. Disabled when not set
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+ADMIN_API_KEY_NAME = "X-Admin-Key"
 
 # Create API key header dependency
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
@@ -20,10 +29,105 @@ api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
 RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", "100"))  # Number of requests
 RATE_LIMIT_PERIOD = int(os.getenv("RATE_LIMIT_PERIOD", "60"))  # Period in seconds
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # "memory" : per worker, "sqlite" : shared by all workers of the host
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", os.path.join(tempfile.gettempdir(), "mytwip_rate_limit.sqlite3"))  # Use a /dev/shm path to share it in memory
+RATE_LIMIT_EVICT_INTERVAL = int(os.getenv("RATE_LIMIT_EVICT_INTERVAL", "60"))  # Idle identifiers are evicted every minute
 
-# Store for rate limiting (in-memory for simplicity)
-# In production, consider using Redis or another distributed cache
-rate_limit_store: Dict[str, List[float]] = {}
+# GCRA : each identifier only keeps its theoretical arrival time (TAT), RATE_LIMIT_REQUESTS requests are allowed in a burst,
+# then one request every RATE_LIMIT_PERIOD / RATE_LIMIT_REQUESTS seconds. Returns (new TAT, 0) if allowed, (TAT, retry after) otherwise
+def gcra_check(tat: float|None, now: float) -> Tuple[float, float]:
+    emission_interval = RATE_LIMIT_PERIOD / RATE_LIMIT_REQUESTS
+    new_tat = max(tat or now, now) + emission_interval
+    retry_after = new_tat - now - RATE_LIMIT_PERIOD
+    if retry_after > 0:
+        return tat, retry_after
+
+    return new_tat, 0.0
+
+
+class MemoryRateLimitStore:
+    """
+    TAT of each identifier, held by the current process.
+    Identifiers are kept in least recently seen order, so that idle ones are evicted from the head.
+    """
+    def __init__(self):
+        self.tats: OrderedDict[str, float] = OrderedDict()
+        self.evicted_at = time.time()
+
+    def check(self, identifier: str, now: float) -> float:
+        tat, retry_after = gcra_check(self.tats.get(identifier), now)
+        self.tats[identifier] = tat
+        self.tats.move_to_end(identifier)
+        if now - self.evicted_at > RATE_LIMIT_EVICT_INTERVAL:
+            self.evict(now)
+
+        return retry_after
+
+    # Drop identifiers back to a full burst : forgetting them changes nothing
+    def evict(self, now: float):
+        self.evicted_at = now
+        while self.tats:
+            identifier, tat = next(iter(self.tats.items()))
+            if tat > now:
+                break
+            del self.tats[identifier]
+
+
+class SqliteRateLimitStore:
+    """
+    TAT of each identifier in a SQLite database, shared by all worker processes of the host.
+    One connection per thread, immediate transactions serialize concurrent checks.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.connection().executescript("""
+            CREATE TABLE IF NOT EXISTS rate_limits (identifier TEXT PRIMARY KEY, tat REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS rate_limits_tat ON rate_limits (tat);
+            CREATE TABLE IF NOT EXISTS rate_limits_eviction (id INTEGER PRIMARY KEY CHECK (id = 0), evicted_at REAL NOT NULL);
+        """)
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            self.local.connection = connection
+
+        return connection
+
+    def check(self, identifier: str, now: float) -> float:
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tat FROM rate_limits WHERE identifier = ?", (identifier,)).fetchone()
+            tat, retry_after = gcra_check(row[0] if row else None, now)
+            connection.execute("INSERT OR REPLACE INTO rate_limits (identifier, tat) VALUES (?, ?)", (identifier, tat))
+            # Only one worker evicts, once per interval
+            evicted = connection.execute(
+                "UPDATE rate_limits_eviction SET evicted_at = ? WHERE id = 0 AND evicted_at < ?", (now, now - RATE_LIMIT_EVICT_INTERVAL)
+            ).rowcount
+            if evicted:
+                connection.execute("DELETE FROM rate_limits WHERE tat <= ?", (now,))
+            else:
+                connection.execute("INSERT OR IGNORE INTO rate_limits_eviction (id, evicted_at) VALUES (0, ?)", (now,))
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+        return retry_after
+
+
+# Build rate limit store : "memory" for the current process, "sqlite" to share it between workers
+def rate_limit_store_get(backend: str):
+    if backend == "sqlite":
+        return SqliteRateLimitStore(RATE_LIMIT_DB)
+
+    return MemoryRateLimitStore()
+
+rate_limit_store = rate_limit_store_get(RATE_LIMIT_BACKEND)
 
 async def get_api_key(api_key_header: str = Security(api_key_header)):
     """
@@ -40,6 +144,14 @@ async def get_api_key(api_key_header: str = Security(api_key_header)):
             status_code=HTTP_403_FORBIDDEN, detail="Invalid API Key"
         )
 
+def is_admin(request: Request) -> bool:
+    """
+    Does request carry the admin key ?
+    """
+    admin_key = request.headers.get(ADMIN_API_KEY_NAME, "")
+
+    return bool(ADMIN_API_KEY) and hmac.compare_digest(admin_key.encode(), ADMIN_API_KEY.encode())
+
 async def rate_limit(request: Request, api_key: str = Depends(get_api_key)):
     """
     Rate limiting middleware
@@ -50,32 +162,14 @@ async def rate_limit(request: Request, api_key: str = Depends(get_api_key)):
     # Use client IP as identifier if no API key
     identifier = api_key if isinstance(api_key, str) else request.client.host
     
-    # Get current time
-    current_time = time.time()
-    
-    # Initialize or get request timestamps for this identifier
-    if identifier not in rate_limit_store:
-        rate_limit_store[identifier] = []
-    
-    # Remove timestamps outside the current period
-    rate_limit_store[identifier] = [
-        timestamp for timestamp in rate_limit_store[identifier]
-        if current_time - timestamp < RATE_LIMIT_PERIOD
-    ]
-    
-    # Check if rate limit exceeded
-    if len(rate_limit_store[identifier]) >= RATE_LIMIT_REQUESTS:
-        # Calculate time until next request is allowed
-        oldest_timestamp = min(rate_limit_store[identifier])
-        retry_after = int(RATE_LIMIT_PERIOD - (current_time - oldest_timestamp))
-        
+    # Constant time check, whatever the number of requests allowed per period
+    retry_after = rate_limit_store.check(identifier, time.time())
+    if retry_after > 0:
+        retry_after = math.ceil(retry_after)
         raise HTTPException(
             status_code=HTTP_429_TOO_MANY_REQUESTS,
             detail=f"Rate limit exceeded. Try again in {retry_after} seconds.",
             headers={"Retry-After": str(retry_after)}
         )
     
-    # Add current request timestamp
-    rate_limit_store[identifier].append(current_time)
-    
     return api_key 
\ No newline at end of file
@@ -0,0 +1,46 @@
+"""
+Request scoped spans, timed with perf timers. Spans of a request are rendered as Server-Timing header and logged.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from mytwip.utils.common import perf_timer_start, perf_timer_stop
+
+# Spans of current request : [(name, duration in seconds)], None outside of a traced request
+trace_spans: ContextVar[list|None] = ContextVar("trace_spans", default=None)
+
+# Start tracing current request. Coroutines and tasks started from here record their spans in it
+def trace_start() -> list:
+    result = []
+    trace_spans.set(result)
+
+    return result
+
+# Time the with block as a span of current request
+@contextmanager
+def span(name: str):
+    spans = trace_spans.get()
+    if spans is None:
+        yield
+        return
+    timer_id = perf_timer_start()
+    try:
+        yield
+    finally:
+        spans.append((name, perf_timer_stop(timer_id)["duration"]))
+
+# Total duration and count of each span name, in order of first occurrence
+def trace_summary(spans: list) -> dict:
+    result = {}
+    for name, duration in spans:
+        summary = result.setdefault(name, {"duration": 0.0, "count": 0})
+        summary["duration"]+= duration
+        summary["count"]+= 1
+
+    return result
+
+# Server-Timing header value, durations in milliseconds
+def trace_server_timing(summary: dict, total: float) -> str:
+    metrics = [f'{name};dur={item["duration"] * 1000:.1f};desc="x{item["count"]}"' for name, item in summary.items()]
+    metrics.append(f"total;dur={total * 1000:.1f}")
+
+    return ", ".join(metrics)